@@ -0,0 +1,92 @@
+"""
+Measure how long it takes to read a merged .jsonl dump, like the
+one created by 'browserexport merge --stream --json'
+
+Compares read_visits against decoding each line separately and
+calling Visit.from_dict on each object (the previous implementation)
+
+python3 benchmarks/json_decode.py [COUNT]
+
+Generates COUNT (default 1,000,000) visits shaped like tests/databases/merged_dump.jsonl
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+from typing import Any, Callable, Iterator, List
+
+from browserexport.model import Visit
+from browserexport.parse import read_visits
+
+
+def generate(path: str, count: int, pages: int = 20_000) -> None:
+    # revisits to the same set of pages, like a real history dump
+    rand = random.Random(0)
+    dt = 1_600_000_000.0
+    with open(path, "w") as f:
+        for i in range(count):
+            page = i % pages
+            dt += rand.random() * 10
+            metadata: Any = {
+                "title": f"Page {page}: A command-line fuzzy finder",
+                "description": None,
+                "preview_image": None,
+                "duration": rand.choice([None, rand.randint(1, 100)]),
+            }
+            if i % 3 == 0:
+                metadata = {k: None for k in metadata}
+            f.write(
+                json.dumps(
+                    {
+                        "url": f"https://github.com/junegunn/fzf/{page}#installation",
+                        "dt": round(dt, 6),
+                        "metadata": metadata,
+                    },
+                    separators=(",", ":"),
+                )
+            )
+            f.write("\n")
+
+
+def _loads() -> Callable[[str], Any]:
+    try:
+        import orjson  # type: ignore[import]
+
+        return orjson.loads  # type: ignore[no-any-return]
+    except ImportError:
+        return json.loads
+
+
+def old(path: str) -> Iterator[Visit]:
+    loads = _loads()
+    with open(path) as fp:
+        for line in fp:
+            yield Visit.from_dict(loads(line))
+
+
+def new(path: str) -> Iterator[Visit]:
+    return read_visits(path)
+
+
+def measure(path: str, read: Callable[[str], Iterator[Visit]]) -> List[Visit]:
+    start = time.perf_counter()
+    vis = list(read(path))
+    elapsed = time.perf_counter() - start
+    print(f"{read.__name__:>4}: {elapsed:.2f}s ({len(vis) / elapsed:,.0f} visits/s)")
+    return vis
+
+
+def main() -> None:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    with tempfile.TemporaryDirectory() as td:
+        path = os.path.join(td, "merged_dump.jsonl")
+        generate(path, count)
+        print(f"{count} visits, {os.path.getsize(path) / 1024**2:.1f}MB")
+        assert measure(path, old) == measure(path, new)
+
+
+if __name__ == "__main__":
+    main()
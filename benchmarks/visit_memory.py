@@ -0,0 +1,98 @@
+"""
+Measure the memory used per visit when all the visits are loaded into a list,
+like the 'vis' variable in the merge REPL
+
+Compares the current Visit against the previous NamedTuple representation
+(a full datetime and a Metadata per row)
+
+python3 benchmarks/visit_memory.py [DATABASE...]
+
+Without any databases, uses generated visits
+"""
+
+import sys
+import gc
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Callable, List, NamedTuple, Optional, Sequence, Tuple, Any
+
+from browserexport.model import Visit, Metadata
+from browserexport.parse import read_visits
+
+
+class NamedTupleVisit(NamedTuple):
+    url: str
+    dt: datetime
+    metadata: Optional[Metadata] = None
+
+
+Row = Tuple[str, float, Optional[str]]
+
+
+def generated_rows(count: int = 500_000, pages: int = 20_000) -> List[Row]:
+    # revisits to the same set of pages, like a real history database
+    start = 1_600_000_000.0
+    return [
+        (
+            f"https://example.com/some/page/{i % pages}?q=search",
+            start + i * 1.000003,
+            f"Title of page {i % pages}",
+        )
+        for i in range(count)
+    ]
+
+
+def database_rows(paths: Sequence[str]) -> List[Row]:
+    rows: List[Row] = []
+    for p in paths:
+        for v in read_visits(p):
+            title = v.metadata.title if v.metadata is not None else None
+            rows.append((v.url, v.serialize()["dt"], title))
+    return rows
+
+
+def _copy(s: Optional[str]) -> Optional[str]:
+    # simulate a new string being decoded for every row
+    return None if s is None else "".join(list(s))
+
+
+def old(row: Row) -> Any:
+    url, ts, title = row
+    return NamedTupleVisit(
+        _copy(url),  # type: ignore[arg-type]
+        datetime.fromtimestamp(ts, tz=timezone.utc),
+        Metadata(title=_copy(title)) if title is not None else None,
+    )
+
+
+def new(row: Row) -> Any:
+    url, ts, title = row
+    return Visit.from_dict(
+        {
+            "url": _copy(url),
+            "dt": ts,
+            "metadata": {"title": _copy(title)} if title is not None else None,
+        }
+    )
+
+
+def measure(rows: List[Row], make: Callable[[Row], Any]) -> float:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    vis = [make(r) for r in rows]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(vis) == len(rows)
+    return (after - before) / len(rows)
+
+
+def main() -> None:
+    rows = database_rows(sys.argv[1:]) if len(sys.argv) > 1 else generated_rows()
+    print(f"{len(rows)} visits")
+    for name, make in (("NamedTuple", old), ("Visit", new)):
+        print(f"{name:>10}: {measure(rows, make):.1f} bytes per visit")
+
+
+if __name__ == "__main__":
+    main()
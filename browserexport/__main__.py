@@ -2,9 +2,18 @@ import sys
 import os
 import logging
 import shlex
-import json as jsn
 from contextlib import contextmanager
-from typing import List, Optional, Sequence, Iterator
+from datetime import datetime
+from typing import (
+    Any,
+    Callable,
+    List,
+    Optional,
+    Sequence,
+    Iterator,
+    TYPE_CHECKING,
+    cast,
+)
 
 import click
 
@@ -12,6 +21,11 @@ from .browsers.all import DEFAULT_BROWSERS
 from .common import BrowserexportError
 from .log import logger
 
+if TYPE_CHECKING:
+    from .model import Visit
+    from .merge import Source
+    from .browsers.common import ExtractOptions
+
 CONTEXT_SETTINGS = {
     "max_content_width": 110,
     "show_default": True,
@@ -59,6 +73,104 @@ stream_json = click.option(
 )
 
 
+DATETIME_FORMATS = ["%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"]
+
+F = Callable[..., Any]
+
+
+def filter_visits(func: F) -> F:
+    """
+    Options to filter the extracted visits, which are passed to read_visits
+    """
+    for opt in reversed(
+        [
+            click.option(
+                "--since",
+                type=click.DateTime(DATETIME_FORMATS),
+                metavar="DATE",
+                default=None,
+                help="Only include visits at or after this time (local time)",
+            ),
+            click.option(
+                "--until",
+                type=click.DateTime(DATETIME_FORMATS),
+                metavar="DATE",
+                default=None,
+                help="Only include visits before this time (local time)",
+            ),
+            click.option(
+                "--url-like",
+                type=str,
+                default=None,
+                help="Only include visits where the URL matches this SQL LIKE pattern (e.g. '%github.com%')",
+            ),
+            click.option(
+                "--fields",
+                type=str,
+                default=None,
+                help="Comma-separated Visit fields to extract, e.g. 'url,dt' to skip reading the metadata",
+            ),
+        ]
+    ):
+        func = opt(func)
+    return func
+
+
+def _extract_options(
+    since: Optional[datetime],
+    until: Optional[datetime],
+    url_like: Optional[str],
+    fields: Optional[str],
+) -> "Optional[ExtractOptions]":
+    from .browsers.common import ExtractOptions
+
+    if since is None and until is None and url_like is None and fields is None:
+        return None
+    # click returns naive datetimes, interpret them as local time
+    return ExtractOptions(
+        since=None if since is None else since.astimezone(),
+        until=None if until is None else until.astimezone(),
+        url_like=url_like,
+        fields=(
+            None
+            if fields is None
+            else tuple(f.strip() for f in fields.split(",") if f.strip())
+        ),
+    )
+
+
+class ByteSize(click.ParamType):  # type: ignore[type-arg]
+    """
+    A size in bytes, with an optional K/M/G suffix (e.g. 512M)
+    """
+
+    name = "size"
+    units = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+    def convert(
+        self, value: Any, param: Optional[click.Parameter], ctx: Optional[click.Context]
+    ) -> int:
+        if isinstance(value, int):
+            return value
+        val = value.strip().upper().rstrip("B")
+        unit = val[-1:] if val[-1:] in self.units else ""
+        try:
+            return int(float(val[: len(val) - len(unit)]) * self.units[unit])
+        except ValueError:
+            self.fail(f"{value!r} is not a valid size (e.g. 1048576, 512M, 2G)")
+
+
+def _human_size(size: int) -> str:
+    if size < 1024:
+        return f"{size}B"
+    n = float(size)
+    for unit in ("KB", "MB", "GB"):
+        n /= 1024
+        if n < 1024 or unit == "GB":
+            break
+    return f"{n:.1f}{unit}"
+
+
 @contextmanager
 def _wrap_browserexport_cli_errors() -> Iterator[None]:
     try:
@@ -141,6 +253,58 @@ LIST_BROWSERS = "LIST_BROWSERS" in os.environ
     required=True,
     help="Directory to store backup to. Pass '-' to print database to STDOUT",
 )
+@click.option(
+    "--skip-unchanged",
+    is_flag=True,
+    default=False,
+    help="Don't create a new backup if the database hasn't changed since the last one",
+)
+@click.option(
+    "--state",
+    "state_path",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="File to save the state of each database to, for --skip-unchanged [default: $XDG_STATE_HOME/browserexport/save.json]",
+)
+@click.option(
+    "--compress",
+    type=click.Choice(["gz", "xz", "zst"], case_sensitive=False),
+    default=None,
+    help="Compress the backup, adds the suffix for the format to the filename. 'zst' requires zstandard",
+)
+@click.option(
+    "--pace",
+    type=ByteSize(),
+    metavar="RATE",
+    default=None,
+    help="Copy the database in small steps, at most RATE bytes per second (e.g. '20M'), to reduce the impact on a browser which is running",
+)
+@click.option(
+    "--no-wal-checkpoint",
+    is_flag=True,
+    default=False,
+    help="With --pace, don't checkpoint the write-ahead log of the backup",
+)
+@click.option(
+    "--all",
+    "all_browsers",
+    is_flag=True,
+    default=False,
+    help="Back up every profile of every browser which is installed",
+)
+@click.option(
+    "--all-profiles",
+    is_flag=True,
+    default=False,
+    help="With --browser, back up every profile which matches --profile, instead of requiring a single match",
+)
+@click.option(
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="With --all/--all-profiles, how many databases to back up at once",
+)
 @click.pass_context
 def save(
     ctx: click.Context,
@@ -149,27 +313,93 @@ def save(
     to: str,
     path: Optional[str],
     pattern: Optional[str],
+    skip_unchanged: bool,
+    state_path: Optional[str],
+    compress: Optional[str],
+    pace: Optional[int],
+    no_wal_checkpoint: bool,
+    all_browsers: bool,
+    all_profiles: bool,
+    jobs: int,
 ) -> None:
     """
     Backs up a current browser database file
     """
-    from .save import backup_history, _path_backup
+    from .save import backup_history, backup_all, _path_backup, Pace
 
     if to != "-" and not os.path.exists(to):
         raise click.BadParameter(
             f"Invalid value for '-t' / '--to': Directory '{to}' does not exist"
         )
 
-    if path is not None:
+    pace_opts: Optional[Pace] = None
+    if pace is not None:
+        with _wrap_browserexport_cli_errors():
+            pace_opts = Pace(pace, wal_checkpoint=not no_wal_checkpoint)
+    elif no_wal_checkpoint:
+        raise click.BadParameter("--no-wal-checkpoint can only be used with --pace")
+
+    if all_browsers or all_profiles:
+        if all_browsers and (browser is not None or path is not None):
+            raise click.BadParameter("--all can't be used with --browser or --path")
+        if all_profiles and browser is None:
+            raise click.BadParameter("--all-profiles requires --browser")
+        if pattern is not None:
+            raise click.BadParameter(
+                "--pattern can't be used with --all/--all-profiles, each backup is named after its browser and profile"
+            )
+        with _wrap_browserexport_cli_errors():
+            results = backup_all(
+                to,
+                browsers=None if all_browsers else [cast(str, browser)],
+                profile=profile,
+                jobs=jobs,
+                skip_unchanged=skip_unchanged,
+                state_path=state_path,
+                compress=compress,
+                pace=pace_opts,
+            )
+        for res in results:
+            name = f"{res.browser} {res.profile}".strip()
+            if res.error is not None:
+                click.echo(f"{name:<40} {click.style('failed', 'red')}: {res.error}")
+            else:
+                click.echo(
+                    f"{name:<40} {_human_size(res.size):>10} {res.seconds:>8.2f}s  {res.dest}"
+                )
+        failed = sum(res.error is not None for res in results)
+        click.echo(
+            f"Backed up {len(results) - failed} of {len(results)} databases, {_human_size(sum(r.size for r in results))} total"
+        )
+        if failed:
+            sys.exit(1)
+    elif path is not None:
         if pattern is not None:
             click.echo(
                 f"Warning: --pattern is not supported while using --path, if you want to backup to a specific path, you can use sqlite_backup directly:\n\npython3 -m sqlite_backup --debug {shlex.quote(path)} {shlex.quote(os.path.join(to, 'filename.sqlite'))}",
                 err=True,
             )
-        _path_backup(path, to)
+        with _wrap_browserexport_cli_errors():
+            _path_backup(
+                path,
+                to,
+                skip_unchanged=skip_unchanged,
+                state_path=state_path,
+                compress=compress,
+                pace=pace_opts,
+            )
     elif browser is not None:
         with _wrap_browserexport_cli_errors():
-            backup_history(browser, to, profile=profile, pattern=pattern)
+            backup_history(
+                browser,
+                to,
+                profile=profile,
+                pattern=pattern,
+                skip_unchanged=skip_unchanged,
+                state_path=state_path,
+                compress=compress,
+                pace=pace_opts,
+            )
     else:
         click.secho(
             "Error: must provide one of '--browser', or '--path'\n",
@@ -179,65 +409,190 @@ def save(
         click.echo(ctx.get_help())
 
 
-def _handle_merge(dbs: List[str], *, json: bool, stream: bool) -> None:
+@cli.command(name="export-new")
+@click.option(
+    "-b",
+    "--browser",
+    type=click.Choice(browsers_have_save, case_sensitive=False),
+    metavar="BROWSER",
+    required=False,
+    help="Browser name to export new visits from",
+)
+@click.option(
+    "-p",
+    "--profile",
+    type=str,
+    default="*",
+    help="Use to pick the correct profile. If unspecified, will assume a single profile",
+)
+@click.option(
+    "--path",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    help="Specify a direct path to a database, instead of locating it",
+)
+@click.option(
+    "--state",
+    "state_path",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="File to store the newest visit exported from each database [default: $XDG_STATE_HOME/browserexport/export-new.json]",
+)
+def export_new(
+    browser: Optional[str],
+    profile: str,
+    path: Optional[str],
+    state_path: Optional[str],
+) -> None:
+    """
+    Prints visits added since the last export as JSON lines
+
+    \b
+    Reads the browser's current database (read-only) instead of making a backup,
+    and keeps track of the newest visit exported from each database, e.g.:
+    browserexport export-new -b chrome >> ~/data/browsing/chrome-new.jsonl
+    """
+    from .incremental import export_new as _export_new
+
+    if browser is None and path is None:
+        raise click.BadParameter("must provide one of '--browser', or '--path'")
+    with _wrap_browserexport_cli_errors():
+        _export_new(
+            browser,
+            sys.stdout.buffer,
+            profile=profile,
+            path=path,
+            state_path=state_path,
+        )
+
+
+@contextmanager
+def _merged_visits(
+    sources: "List[Source]",
+    *,
+    jobs: int,
+    max_memory: Optional[int],
+    sort: bool,
+    options: "Optional[ExtractOptions]" = None,
+    snapshots: bool = False,
+) -> "Iterator[Iterator[Visit]]":
+    """
+    Merge the visits from each source, extracting from paths using
+    a process pool if jobs > 1. The pool is shut down on exit
+    """
+    from pathlib import Path
+    from concurrent.futures import ProcessPoolExecutor
+    from .merge import merge_visits, parallel_sources, _read_visits, snapshot_options
+
+    src_options = [options] * len(sources)
+    if snapshots:
+        paths = {i: s for i, s in enumerate(sources) if isinstance(s, Path)}
+        for i, opts in zip(paths, snapshot_options(list(paths.values()), options)):
+            src_options[i] = opts
+
+    if jobs <= 1:
+        yield merge_visits(
+            [
+                _read_visits(s, opts) if isinstance(s, Path) else s
+                for s, opts in zip(sources, src_options)
+            ],
+            max_memory=max_memory,
+            sorted=sort,
+        )
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield merge_visits(
+            parallel_sources(
+                executor, sources, prefetch=jobs, source_options=src_options
+            ),
+            max_memory=max_memory,
+            sorted=sort,
+        )
+
+
+def _handle_merge(
+    dbs: List[str],
+    *,
+    json: bool,
+    stream: bool,
+    jobs: int = 1,
+    max_memory: Optional[int] = None,
+    sort: bool = False,
+    output: Optional[str] = None,
+    options: "Optional[ExtractOptions]" = None,
+    snapshots: bool = False,
+) -> None:
+    # imported at runtime so Visit is available in the REPL
     from .model import Visit
     from .common import expand_path
-    from .merge import merge_visits
-    from .parse import read_visits, _read_buf_as_sqlite_db
+    from .parse import _read_buf_as_sqlite_db
+    from .merge import _read_visits
 
-    visits: List[Iterator[Visit]] = []
+    visits: List[Source] = []
 
     with _wrap_browserexport_cli_errors():
         for db in dbs:
             if db == "-":
                 logger.debug("Reading stdin as sqlite database")
-                visits.append(read_visits(_read_buf_as_sqlite_db(sys.stdin.buffer)))
+                visits.append(
+                    _read_visits(_read_buf_as_sqlite_db(sys.stdin.buffer), options)
+                )
                 continue
             # this is a command substitution, write it to a temp database so we can query against it
             # e.g. `browserexport merge <(browserexport save -b chrome -t -)`
             if os.path.islink(db) and os.readlink(db).startswith("pipe:"):
                 logger.debug(f"Reading from proc file {db} into sqlite database")
                 with open(db, "rb") as fp:
-                    visits.append(read_visits(_read_buf_as_sqlite_db(fp)))
+                    visits.append(_read_visits(_read_buf_as_sqlite_db(fp), options))
                 continue
             if not os.path.exists(db):
                 raise click.BadParameter(
                     f"Invalid value for SQLITE_DB: File '{db}' does not exist"
                 )
             else:
-                visits.append(read_visits(expand_path(db)))
-
-        ivis: Iterator[Visit] = merge_visits(visits)
-        if json or stream:
-            if stream:
-                for v in ivis:
-                    sys.stdout.write(jsn.dumps(v.serialize(), separators=(",", ":")))
-                    sys.stdout.write("\n")
-                sys.stdout.flush()
-            else:
-                click.echo(
-                    jsn.dumps([v.serialize() for v in ivis], separators=(",", ":"))
-                )
-        else:
-            from .demo import demo_visit
+                # paths are read lazily, so they can be extracted in parallel
+                visits.append(expand_path(db))
+
+        with _merged_visits(
+            visits,
+            jobs=jobs,
+            max_memory=max_memory,
+            sort=sort,
+            options=options,
+            snapshots=snapshots,
+        ) as ivis:
+            if output is not None:
+                from .write import write_visits
+
+                write_visits(ivis, output)
+                return
+            if json or stream:
+                from .write import write_json
 
+                sys.stdout.flush()
+                write_json(ivis, sys.stdout.buffer, lines=stream)
+                sys.stdout.buffer.flush()
+                return
             vis: List[Visit] = list(ivis)
-            demo_visit(vis)
-            header = f"Use {click.style('vis', fg='green')} to access visit data"
-
-            try:
-                import IPython  # type: ignore[import]
-            except ModuleNotFoundError:
-                click.secho(
-                    "You may want to 'python3 -m pip install IPython' for a better REPL experience",
-                    fg="yellow",
-                )
 
-                import code
+        from .demo import demo_visit
 
-                code.interact(local=locals(), banner=header)
-            else:
-                IPython.embed(header=header)  # type: ignore[no-untyped-call]
+        demo_visit(vis)
+        header = f"Use {click.style('vis', fg='green')} to access visit data"
+
+        try:
+            import IPython  # type: ignore[import]
+        except ModuleNotFoundError:
+            click.secho(
+                "You may want to 'python3 -m pip install IPython' for a better REPL experience",
+                fg="yellow",
+            )
+
+            import code
+
+            code.interact(local=locals(), banner=header)
+        else:
+            IPython.embed(header=header)  # type: ignore[no-untyped-call]
 
 
 @cli.command()
@@ -246,7 +601,16 @@ def _handle_merge(dbs: List[str], *, json: bool, stream: bool) -> None:
 )
 @stream_json
 @print_json
-def inspect(sqlite_db: str, json: bool, stream: bool) -> None:
+@filter_visits
+def inspect(
+    sqlite_db: str,
+    json: bool,
+    stream: bool,
+    since: Optional[datetime],
+    until: Optional[datetime],
+    url_like: Optional[str],
+    fields: Optional[str],
+) -> None:
     """
     Extracts visits from a single sqlite database
 
@@ -257,7 +621,12 @@ def inspect(sqlite_db: str, json: bool, stream: bool) -> None:
     Pass '-' to read from STDIN
     """
     with _wrap_browserexport_cli_errors():
-        _handle_merge([sqlite_db], json=json, stream=stream)
+        _handle_merge(
+            [sqlite_db],
+            json=json,
+            stream=stream,
+            options=_extract_options(since, until, url_like, fields),
+        )
 
 
 @cli.command()
@@ -269,7 +638,53 @@ def inspect(sqlite_db: str, json: bool, stream: bool) -> None:
 )
 @stream_json
 @print_json
-def merge(sqlite_db: Sequence[str], json: bool, stream: bool) -> None:
+@click.option(
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of processes to use to extract visits from databases in parallel",
+)
+@click.option(
+    "--max-memory",
+    type=ByteSize(),
+    default=None,
+    help="Approximate memory limit for the index used to remove duplicates (e.g. 512M). Once reached, the index is written to a temporary database on disk",
+)
+@click.option(
+    "--sorted",
+    "sort",
+    is_flag=True,
+    default=False,
+    help="Merge the databases into a single stream of visits, sorted by time",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="Write the merged visits to a file instead, the format is picked from the extension (.sqlite, .visits, .json, .jsonl)",
+)
+@click.option(
+    "--snapshots",
+    is_flag=True,
+    default=False,
+    help="The databases are backups of the same profile(s), only read the visits added after the previous backup",
+)
+@filter_visits
+def merge(
+    sqlite_db: Sequence[str],
+    json: bool,
+    stream: bool,
+    jobs: int,
+    max_memory: Optional[int],
+    sort: bool,
+    output: Optional[str],
+    snapshots: bool,
+    since: Optional[datetime],
+    until: Optional[datetime],
+    url_like: Optional[str],
+    fields: Optional[str],
+) -> None:
     """
     Extracts visits from multiple sqlite databases
 
@@ -281,8 +696,56 @@ def merge(sqlite_db: Sequence[str], json: bool, stream: bool) -> None:
 
     Pass '-' to read from STDIN
     """
+    if output is not None and (json or stream):
+        raise click.UsageError(
+            "--output can't be used with --json/--stream, the format is picked from the extension"
+        )
+    if max_memory is not None and sort:
+        raise click.UsageError(
+            "--max-memory can't be used with --sorted, which only compares neighbouring visits"
+        )
+    with _wrap_browserexport_cli_errors():
+        _handle_merge(
+            list(sqlite_db),
+            json=json,
+            stream=stream,
+            jobs=jobs,
+            max_memory=max_memory,
+            sort=sort,
+            output=output,
+            options=_extract_options(since, until, url_like, fields),
+            snapshots=snapshots,
+        )
+
+
+@cli.command()
+@click.argument(
+    "input_path",
+    metavar="INPUT",
+    type=click.Path(exists=True, dir_okay=False),
+    required=True,
+)
+@click.argument(
+    "output_path",
+    metavar="OUTPUT",
+    type=click.Path(dir_okay=False, writable=True),
+    required=True,
+)
+def convert(input_path: str, output_path: str) -> None:
+    """
+    Converts a database or merged dump to another format
+
+    \b
+    The format is picked from the OUTPUT extension:
+    .visits: compact binary archive, which is much faster to read than JSON
+    .sqlite: sqlite database, which can be queried or merged again
+    .json/.jsonl: a JSON list, or one JSON object per line
+    """
+    from .write import write_visits
+    from .parse import read_visits
+
     with _wrap_browserexport_cli_errors():
-        _handle_merge(list(sqlite_db), json=json, stream=stream)
+        write_visits(read_visits(input_path), output_path)
 
 
 if __name__ == "__main__":
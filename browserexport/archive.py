@@ -0,0 +1,265 @@
+"""
+A compact, columnar binary format for merged visits
+
+The file is laid out as:
+
+    header    (see HEADER below)
+    columns   one array per field, each 'count' items long:
+                timestamp      int64, microseconds since the epoch
+                duration       int64, NONE_INT if missing
+                url            uint32, index into the string table
+                title          uint32, index into the string table, NONE_STR if missing
+                description    uint32, ...
+                preview_image  uint32, ...
+    offsets   uint64[strings + 1], start/end of each string in the blob
+    blob      UTF-8 encoded strings
+
+All integers are little-endian. Reading the file memory-maps it,
+and each row is decoded lazily when it is accessed
+"""
+
+import sys
+import mmap
+import struct
+from array import array
+from types import TracebackType
+from typing import (
+    Iterator,
+    Iterable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+    BinaryIO,
+)
+
+from kompress import is_compressed, CPath
+
+from .common import PathIsh, expand_path, BrowserexportError
+from .model import Visit, Metadata
+from .log import logger
+
+ARCHIVE_EXT = ".visits"
+
+MAGIC = b"BRWSEXP\x00"
+VERSION = 1
+# magic, version, visit count, string count
+HEADER = struct.Struct("<8sIQQ")
+
+NONE_INT = -(1 << 63)
+NONE_STR = 0xFFFFFFFF
+
+# (name, array typecode), in the order they're stored in the file
+COLUMNS = (
+    ("timestamp", "q"),
+    ("duration", "q"),
+    ("url", "I"),
+    ("title", "I"),
+    ("description", "I"),
+    ("preview_image", "I"),
+)
+
+Buffer = Union[mmap.mmap, bytes]
+
+
+def _to_le(arr: "array[int]") -> "array[int]":
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr
+
+
+class _StringTable:
+    def __init__(self) -> None:
+        self.index: Dict[str, int] = {}
+        self.strings: List[str] = []
+
+    def add(self, s: Optional[str]) -> int:
+        if s is None:
+            return NONE_STR
+        i = self.index.get(s)
+        if i is None:
+            i = self.index[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+
+def write_archive(visits: Iterable[Visit], path: PathIsh) -> int:
+    """
+    Write visits to path in the archive format. Returns the number of visits written
+    """
+    table = _StringTable()
+    cols: Dict[str, "array[int]"] = {name: array(code) for name, code in COLUMNS}
+    for v in visits:
+        md = v.metadata
+        cols["timestamp"].append(v.ts)
+        cols["url"].append(table.add(v.url))
+        if md is None:
+            cols["duration"].append(NONE_INT)
+            cols["title"].append(NONE_STR)
+            cols["description"].append(NONE_STR)
+            cols["preview_image"].append(NONE_STR)
+        else:
+            cols["duration"].append(NONE_INT if md.duration is None else md.duration)
+            cols["title"].append(table.add(md.title))
+            cols["description"].append(table.add(md.description))
+            cols["preview_image"].append(table.add(md.preview_image))
+
+    count = len(cols["timestamp"])
+    offsets = array("Q", [0])
+    encoded: List[bytes] = []
+    for s in table.strings:
+        b = s.encode("utf-8", errors="surrogatepass")
+        encoded.append(b)
+        offsets.append(offsets[-1] + len(b))
+
+    with expand_path(path).open("wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, count, len(table.strings)))
+        for name, _ in COLUMNS:
+            f.write(_to_le(cols[name]).tobytes())
+        f.write(_to_le(offsets).tobytes())
+        for b in encoded:
+            f.write(b)
+    logger.info(f"Wrote {count} visits ({len(table.strings)} strings) to {path}")
+    return count
+
+
+class VisitArchive:
+    """
+    Reads visits from an archive. Supports len(), indexing and iteration,
+    rows are only decoded when they're accessed
+    """
+
+    def __init__(self, path: PathIsh) -> None:
+        self.path = expand_path(path)
+        self._file: Optional[BinaryIO] = None
+        self._buf: Buffer
+        if is_compressed(self.path.name):
+            # can't memory map a compressed file, decompress into memory instead
+            with CPath(self.path).open("rb") as f:  # type: ignore
+                self._buf = f.read()
+        else:
+            self._file = self.path.open("rb")
+            self._buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._buf) < HEADER.size:
+            raise BrowserexportError(f"{self.path} is too small to be a visit archive")
+        magic, version, count, nstrings = HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC:
+            raise BrowserexportError(f"{self.path} is not a visit archive")
+        if version != VERSION:
+            raise BrowserexportError(
+                f"{self.path} has unsupported archive version {version}"
+            )
+        self.count: int = count
+        self._view = memoryview(self._buf)
+        self._cols: Dict[str, Union[memoryview, "array[int]"]] = {}
+        offset = HEADER.size
+        for name, code in COLUMNS:
+            self._cols[name], offset = self._column(offset, code, count)
+        self._offsets, offset = self._column(offset, "Q", nstrings + 1)
+        self._blob = offset
+        self._strings: Dict[int, str] = {}
+
+    def _column(
+        self, offset: int, code: str, length: int
+    ) -> Tuple["Union[memoryview, array[int]]", int]:
+        end = offset + array(code).itemsize * length
+        if end > len(self._buf):
+            raise BrowserexportError(f"{self.path} is truncated")
+        raw = self._view[offset:end]
+        if sys.byteorder == "little":
+            return raw.cast(code), end  # type: ignore[call-overload]
+        # big-endian host, copy and swap
+        arr = array(code, raw.tobytes())
+        arr.byteswap()
+        return arr, end
+
+    def _string(self, i: int) -> Optional[str]:
+        if i == NONE_STR:
+            return None
+        s = self._strings.get(i)
+        if s is None:
+            start = self._blob + self._offsets[i]
+            end = self._blob + self._offsets[i + 1]
+            s = self._strings[i] = str(
+                self._view[start:end], "utf-8", errors="surrogatepass"
+            )
+        return s
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> Visit:
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        cols = self._cols
+        duration = cols["duration"][i]
+        url = self._string(cols["url"][i])
+        assert url is not None
+        return Visit.from_micros(
+            url,
+            cols["timestamp"][i],
+            Metadata.make(
+                title=self._string(cols["title"][i]),
+                description=self._string(cols["description"][i]),
+                preview_image=self._string(cols["preview_image"][i]),
+                duration=None if duration == NONE_INT else duration,
+            ),
+        )
+
+    def __iter__(self) -> Iterator[Visit]:
+        # same as self[i] for each row, but avoids the per-row lookups
+        string = self._string
+        for ts, duration, url, title, desc, img in zip(
+            *(self._cols[name] for name, _ in COLUMNS)
+        ):
+            metadata: Optional[Metadata] = None
+            if (
+                title != NONE_STR
+                or desc != NONE_STR
+                or img != NONE_STR
+                or duration != NONE_INT
+            ):
+                metadata = Metadata(
+                    string(title),
+                    string(desc),
+                    string(img),
+                    None if duration == NONE_INT else duration,
+                )
+            yield Visit.from_micros(string(url), ts, metadata)  # type: ignore[arg-type]
+
+    def close(self) -> None:
+        # release the memoryviews before closing the mmap
+        for col in (*self._cols.values(), self._offsets):
+            if isinstance(col, memoryview):
+                col.release()
+        self._cols.clear()
+        self._view.release()
+        if isinstance(self._buf, mmap.mmap):
+            self._buf.close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self) -> "VisitArchive":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+
+def read_archive(path: PathIsh) -> Iterator[Visit]:
+    """
+    Lazily read visits from an archive
+    """
+    with VisitArchive(path) as archive:
+        yield from archive
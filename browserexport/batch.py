@@ -0,0 +1,139 @@
+"""
+Columnar batches of visits, for reading lots of visits
+without creating a Visit object for each row
+"""
+
+from array import array
+from functools import lru_cache
+from itertools import islice
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Iterator, List, Optional, Sequence, Union
+
+from .model import Visit, Metadata, Microsecond, Second, timestamp_to_micros
+
+DEFAULT_BATCH_SIZE = 10_000
+
+
+@lru_cache(maxsize=1)
+def _numpy() -> Any:
+    try:
+        import numpy  # type: ignore[import]
+    except ImportError:
+        return None
+    return numpy
+
+
+def has_numpy() -> bool:
+    return _numpy() is not None
+
+
+# int64 microseconds since the epoch, a numpy array if numpy is installed,
+# else an array('q'). Both support len(), indexing and iteration
+Timestamps = Union["array[int]", Any]
+
+
+def micros_array(values: Iterable[Microsecond]) -> Timestamps:
+    """
+    Create a timestamp column from integer microseconds
+    """
+    np = _numpy()
+    if np is not None:
+        return np.fromiter(values, dtype=np.int64)
+    return array("q", values)
+
+
+def seconds_to_micros(seconds: Any, offset: int = 0) -> Timestamps:
+    """
+    Convert float timestamps (a sequence, or numpy array) plus offset to a
+    timestamp column, rounding the same way as model.timestamp_to_micros
+    """
+    np = _numpy()
+    if np is None:
+        return array("q", (timestamp_to_micros(s + offset) for s in seconds))
+    secs = np.asarray(seconds, dtype=np.float64) + offset
+    whole = np.trunc(secs)
+    # both round half to even, like python's round
+    frac = np.round((secs - whole) * 1_000_000)
+    return whole.astype(np.int64) * 1_000_000 + frac.astype(np.int64)
+
+
+def scaled_seconds_to_micros(
+    values: Sequence[int], scale: int, offset: int
+) -> Timestamps:
+    """
+    Same as seconds_to_micros([(v / scale) - offset for v in values]), for
+    large integer timestamps (e.g. chrome's microseconds since 1601)
+    """
+    np = _numpy()
+    if np is None:
+        return seconds_to_micros([(v / scale) - offset for v in values])
+    # these are larger than 2**53, so converting them to floats before dividing would
+    # round differently than python's int / int. dividing the remainder separately
+    # gives the same (correctly rounded) result
+    q, r = np.divmod(np.asarray(values, dtype=np.int64), scale)
+    return seconds_to_micros(q.astype(np.float64) + r / scale, -offset)
+
+
+def _nones(n: int) -> List[Any]:
+    return [None] * n
+
+
+@dataclass
+class VisitBatch:
+    """
+    A batch of visits, with one list/array per field. Every
+    column has the same length, missing values are None
+    """
+
+    urls: List[str]
+    timestamps: Timestamps
+    titles: List[Optional[str]] = field(default_factory=list)
+    descriptions: List[Optional[str]] = field(default_factory=list)
+    preview_images: List[Optional[str]] = field(default_factory=list)
+    durations: List[Optional[Second]] = field(default_factory=list)
+
+    def __post_init__(self) -> None:
+        # metadata columns which weren't provided are all None
+        n = len(self.urls)
+        for name in ("titles", "descriptions", "preview_images", "durations"):
+            if not getattr(self, name):
+                setattr(self, name, _nones(n))
+
+    def __len__(self) -> int:
+        return len(self.urls)
+
+    def visits(self) -> Iterator[Visit]:
+        """
+        Convert the batch back into Visits
+        """
+        for url, ts, title, desc, img, dur in zip(
+            self.urls,
+            self.timestamps,
+            self.titles,
+            self.descriptions,
+            self.preview_images,
+            self.durations,
+        ):
+            yield Visit.from_micros(url, int(ts), Metadata.make(title, desc, img, dur))
+
+
+def batches_from_visits(
+    visits: Iterable[Visit], batch_size: int = DEFAULT_BATCH_SIZE
+) -> Iterator[VisitBatch]:
+    """
+    Group visits into batches, for sources which don't support reading batches directly
+    """
+    it = iter(visits)
+    while True:
+        chunk: Sequence[Visit] = list(islice(it, batch_size))
+        if not chunk:
+            return
+        mds = [v.metadata or Metadata() for v in chunk]
+        yield VisitBatch(
+            urls=[v.url for v in chunk],
+            timestamps=micros_array(v.ts for v in chunk),
+            titles=[m.title for m in mds],
+            descriptions=[m.description for m in mds],
+            preview_images=[m.preview_image for m in mds],
+            durations=[m.duration for m in mds],
+        )
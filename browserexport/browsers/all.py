@@ -16,6 +16,7 @@ from .edgedev import EdgeDev
 from .librewolf import Librewolf
 from .floorp import Floorp
 from .opera import Opera
+from .browserexport_archive import BrowserexportArchive
 
 # As this is a namespace package, you're free to add additional files
 # to this package in a separate directory, and then append them (or override this file, by
@@ -45,4 +46,5 @@ DEFAULT_BROWSERS: List[Type[Browser]] = [
     Arc,
     Edge,
     EdgeDev,
+    BrowserexportArchive,
 ]
@@ -0,0 +1,73 @@
+from .common import (
+    Iterator,
+    Visit,
+    Metadata,
+    PathIshOrConn,
+    Browser,
+    Path,
+    Schema,
+    execute_query,
+    Paths,
+    Optional,
+    ExtractOptions,
+    Microsecond,
+    range_condition,
+    extracts_metadata,
+)
+
+
+class BrowserexportArchive(Browser):
+    """
+    A merged archive, created by 'browserexport merge --output archive.sqlite'
+    See browserexport/write.py for the schema
+    """
+
+    detector = "browserexport_archive"
+    schema = Schema(
+        cols=[
+            "U.url",
+            "V.visit_time",
+        ],
+        metadata_cols=[
+            "V.title",
+            "V.description",
+            "V.preview_image",
+            "V.duration",
+        ],
+        where="FROM visits as V, urls as U WHERE V.url_id = U.id",
+        order_by="V.visit_time",
+        url_col="U.url",
+    )
+    has_save = False
+
+    @classmethod
+    def time_condition(
+        cls, since: Optional[Microsecond], until: Optional[Microsecond]
+    ) -> Optional[str]:
+        return range_condition("V.visit_time", since, until)
+
+    @classmethod
+    def extract_visits(
+        cls, path: PathIshOrConn, options: Optional[ExtractOptions] = None
+    ) -> Iterator[Visit]:
+        query, params = cls.build_query(options)
+        metadata = extracts_metadata(options)
+        for row in execute_query(path, query, params):
+            md: Optional[Metadata] = None
+            if metadata:
+                md = Metadata.make(
+                    title=row["title"],
+                    description=row["description"],
+                    preview_image=row["preview_image"],
+                    duration=row["duration"],
+                )
+            # urls are stored unquoted, no need to unquote them again
+            yield Visit.from_micros(row["url"], row["visit_time"], md)
+
+    @classmethod
+    def data_directories(cls) -> Paths:
+        raise NotImplementedError("Created by 'browserexport merge', not a browser")
+
+    @classmethod
+    def locate_database(cls, profile: str = "*") -> Path:
+        raise NotImplementedError("Created by 'browserexport merge', not a browser")
@@ -1,5 +1,3 @@
-from urllib.parse import unquote
-
 from .common import (
     Iterator,
     Visit,
@@ -8,21 +6,40 @@ from .common import (
     Browser,
     Schema,
     Path,
-    datetime,
-    timezone,
     handle_glob,
+    glob_databases,
+    List,
     handle_path,
     windows_appdata_paths,
     execute_query,
     Paths,
+    Optional,
+    ExtractOptions,
+    Microsecond,
+    range_condition,
+    extracts_metadata,
+    timestamp_to_micros,
+    DEFAULT_BATCH_SIZE,
+    VisitBatch,
+    execute_query_batched,
+    columns,
+    scaled_seconds_to_micros,
+    unquote_by_id,
 )
 
 WINDOWS_EPOCH_OFFSET = 11644473600
 
 
-def _chrome_date_to_utc(chrome_time: int) -> datetime:
-    ts = (chrome_time / 1_000_000) - WINDOWS_EPOCH_OFFSET
-    return datetime.fromtimestamp(ts, tz=timezone.utc)
+def _chrome_date_to_micros(chrome_time: int) -> Microsecond:
+    # converts through float seconds, like the datetime conversion older versions used,
+    # so timestamps match older JSON dumps
+    return timestamp_to_micros((chrome_time / 1_000_000) - WINDOWS_EPOCH_OFFSET)
+
+
+def _utc_to_chrome_date(us: Optional[Microsecond]) -> Optional[int]:
+    if us is None:
+        return None
+    return us + WINDOWS_EPOCH_OFFSET * 1_000_000
 
 
 class Chrome(Browser):
@@ -31,26 +48,70 @@ class Chrome(Browser):
     schema = Schema(
         cols=[
             "U.url",
-            "U.title",
+            "U.id AS url_id",
             "V.visit_time",
+        ],
+        metadata_cols=[
+            "U.title",
             "V.visit_duration",
         ],
         where="FROM visits as V, urls as U WHERE V.url = U.id",
         order_by="V.visit_time",
+        url_col="U.url",
+        id_col="V.id",
     )
 
     @classmethod
-    def extract_visits(cls, path: PathIshOrConn) -> Iterator[Visit]:
-        for row in execute_query(path, cls.schema.query):
-            dur = int(row["visit_duration"])
-            yield Visit(
-                url=unquote(row["url"]),
-                dt=_chrome_date_to_utc(row["visit_time"]),
-                metadata=Metadata.make(
+    def time_condition(
+        cls, since: Optional[Microsecond], until: Optional[Microsecond]
+    ) -> Optional[str]:
+        return range_condition(
+            "V.visit_time", _utc_to_chrome_date(since), _utc_to_chrome_date(until)
+        )
+
+    @classmethod
+    def extract_visits(
+        cls, path: PathIshOrConn, options: Optional[ExtractOptions] = None
+    ) -> Iterator[Visit]:
+        query, params = cls.build_query(options)
+        metadata = extracts_metadata(options)
+        unquote_url = unquote_by_id()
+        for row in execute_query(path, query, params):
+            url = unquote_url(row["url_id"], row["url"])
+            md: Optional[Metadata] = None
+            if metadata:
+                dur = int(row["visit_duration"])
+                md = Metadata.make(
                     title=row["title"],
                     duration=None if dur == 0 else dur // 1_000_000,
+                )
+            yield Visit.from_micros(url, _chrome_date_to_micros(row["visit_time"]), md)
+
+    @classmethod
+    def extract_batches(
+        cls,
+        path: PathIshOrConn,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        options: Optional[ExtractOptions] = None,
+    ) -> Iterator[VisitBatch]:
+        query, params = cls.build_query(options)
+        metadata = extracts_metadata(options)
+        unquote_url = unquote_by_id()
+        for rows in execute_query_batched(path, query, params, batch_size=batch_size):
+            cols = columns(rows)
+            batch = VisitBatch(
+                urls=list(map(unquote_url, cols["url_id"], cols["url"])),
+                timestamps=scaled_seconds_to_micros(
+                    cols["visit_time"], 1_000_000, WINDOWS_EPOCH_OFFSET
                 ),
             )
+            if metadata:
+                batch.titles = list(cols["title"])
+                batch.durations = [
+                    None if dur == 0 else int(dur) // 1_000_000
+                    for dur in cols["visit_duration"]
+                ]
+            yield batch
 
     @classmethod
     def data_directories(cls) -> Paths:
@@ -70,3 +131,7 @@ class Chrome(Browser):
     def locate_database(cls, profile: str = "*") -> Path:
         dd = cls.data_directories()
         return handle_glob(dd, profile + "/History")
+
+    @classmethod
+    def locate_databases(cls, profile: str = "*") -> List[Path]:
+        return glob_databases(cls.data_directories(), profile + "/History")
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 import sqlite3
 
@@ -6,7 +7,10 @@ from itertools import chain
 from pathlib import Path
 from functools import lru_cache
 from datetime import datetime, timezone
+from urllib.parse import unquote
 from typing import (
+    Any,
+    Callable,
     Generator,
     List,
     Iterator,
@@ -14,16 +18,22 @@ from typing import (
     Dict,
     Union,
     Sequence,
+    Tuple,
+    cast,
 )
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 import click
 
 from ..log import logger
-from ..model import Visit
-from ..model import Metadata  # noqa: F401
+from ..model import Visit, Microsecond, datetime_to_micros
+from ..model import Metadata, timestamp_to_micros  # noqa: F401
 from ..common import PathIsh, PathIshOrConn, expand_path, BrowserexportError
-from ..sqlite import execute_query
+from ..sqlite import execute_query, list_tables, Tables, Params
+from ..sqlite import execute_query_batched, columns  # noqa: F401
+from ..batch import VisitBatch, DEFAULT_BATCH_SIZE, batches_from_visits
+from ..batch import micros_array, seconds_to_micros  # noqa: F401
+from ..batch import scaled_seconds_to_micros  # noqa: F401
 
 
 @dataclass
@@ -31,18 +41,165 @@ class Schema:
     cols: List[str]
     where: str
     order_by: Optional[str] = None
+    url_col: Optional[str] = None  # column to match url_like against
+    # the visit table's integer primary key, which increases for each new visit
+    id_col: Optional[str] = None
+    # columns only used to create the Metadata, not selected if its not requested
+    metadata_cols: List[str] = field(default_factory=list)
 
-    @property
-    def query(self) -> str:
-        qr = f"SELECT {', '.join(self.cols)} {self.where}"
+    def build_query(self, conditions: Sequence[str] = (), metadata: bool = True) -> str:
+        """
+        Build the query, adding any additional conditions to the WHERE clause
+        """
+        where = self.where
+        if conditions:
+            joined = " AND ".join(f"({c})" for c in conditions)
+            if " where " in f" {where.lower()} ":
+                where = f"{where} AND {joined}"
+            else:
+                where = f"{where} WHERE {joined}"
+        cols = self.cols + self.metadata_cols if metadata else self.cols
+        qr = f"SELECT {', '.join(cols)} {where}"
         if self.order_by is not None:
             qr += f" ORDER BY {self.order_by}"
         return qr
 
+    @property
+    def query(self) -> str:
+        return self.build_query()
+
+
+@lru_cache(maxsize=None)
+def _like_to_regex(pattern: str) -> "re.Pattern[str]":
+    # sqlite's LIKE is case-insensitive for ASCII characters, '%' and '_' are wildcards
+    parts = [".*" if c == "%" else "." if c == "_" else re.escape(c) for c in pattern]
+    return re.compile("".join(parts), re.IGNORECASE | re.DOTALL)
+
+
+@dataclass(frozen=True)
+class ExtractOptions:
+    """
+    Options passed from read_visits to each browser's extract_visits, to
+    restrict which visits are extracted. The field names match
+    the keyword arguments to read_visits
+
+    since/until are timezone-aware datetimes (since <= visit < until),
+    url_like is a SQL LIKE pattern, matched against the url
+    as it's stored in the database
+
+    fields are the names of the Visit fields to extract, if 'metadata'
+    isn't included, the metadata columns aren't selected and the
+    Visit.metadata is always None
+
+    after_id only extracts visits where the visit table's id (Schema.id_col)
+    is greater than after_id, which is used to read the new visits in a backup
+    """
+
+    since: Optional[datetime] = None
+    until: Optional[datetime] = None
+    url_like: Optional[str] = None
+    fields: Optional[Tuple[str, ...]] = None
+    after_id: Optional[int] = None
+
+    def __post_init__(self) -> None:
+        if self.fields is None:
+            return
+        # so a list can be passed as well, and the options are still hashable
+        object.__setattr__(self, "fields", tuple(self.fields))
+        unknown = set(self.fields) - set(Visit._fields)
+        if unknown:
+            raise BrowserexportError(
+                f"Unknown fields {sorted(unknown)}, expected some of {list(Visit._fields)}"
+            )
+        if "url" not in self.fields or "dt" not in self.fields:
+            raise BrowserexportError("fields must include 'url' and 'dt'")
+
+    @property
+    def metadata(self) -> bool:
+        return self.fields is None or "metadata" in self.fields
+
+    @property
+    def filters_time(self) -> bool:
+        return self.since is not None or self.until is not None
+
+    def time_range(self) -> Tuple[Optional[Microsecond], Optional[Microsecond]]:
+        return (
+            None if self.since is None else datetime_to_micros(self.since),
+            None if self.until is None else datetime_to_micros(self.until),
+        )
+
+    def matches(self, visit: Visit) -> bool:
+        """
+        Check the filters in python, for sources which can't push them into a query
+        """
+        if self.filters_time:
+            since, until = self.time_range()
+            ts = visit.ts
+            if since is not None and ts < since:
+                return False
+            if until is not None and ts >= until:
+                return False
+        if self.url_like is not None:
+            if _like_to_regex(self.url_like).fullmatch(visit.url) is None:
+                return False
+        return True
+
+    def project(self, visit: Visit) -> Visit:
+        """
+        Remove any fields which weren't requested
+        """
+        if self.metadata or visit.metadata is None:
+            return visit
+        return visit._replace(metadata=None)
+
+
+def extracts_metadata(options: Optional[ExtractOptions]) -> bool:
+    """
+    Whether extract_visits should select the metadata columns/create Metadata
+    """
+    return options is None or options.metadata
+
+
+Number = Union[int, float]
+
+
+def range_condition(col: str, lo: Optional[Number], hi: Optional[Number]) -> str:
+    """
+    Create a condition for lo <= col < hi. lo/hi are always numbers
+    computed from timestamps, so they're safe to format into the query
+    """
+    parts: List[str] = []
+    if lo is not None:
+        parts.append(f"{col} >= {lo!r}")
+    if hi is not None:
+        parts.append(f"{col} < {hi!r}")
+    return " AND ".join(parts) or "1"
+
 
 Detector = str
 Paths = Sequence[Path]
 
+# matches detectors which just check that some tables exist, e.g. 'SELECT * FROM moz_meta, moz_annos'
+DETECTOR_TABLES_RE = re.compile(
+    r"^select\s+\*\s+from\s+(\w+(?:\s*,\s*\w+)*)\s*;?$", re.IGNORECASE
+)
+
+
+def detector_tables(detector: Detector) -> Optional[Tables]:
+    """
+    Parse the names of the tables the detector requires to exist
+
+    Returns None if the detector is some other query, which
+    has to be run against the database
+    """
+    detector = detector.strip().lower()
+    if " " not in detector:
+        return frozenset([detector])
+    match = DETECTOR_TABLES_RE.match(detector)
+    if match is None:
+        return None
+    return frozenset(t.strip() for t in match.group(1).split(","))
+
 
 @dataclass
 class Browser:
@@ -50,16 +207,29 @@ class Browser:
     detector: Detector  # semi-unique name of table, or a query to run on database to detect this type
     has_save: bool = True  # if this browser works with the save command
 
+    @classmethod
+    def detect_tables(cls, tables: Tables) -> Optional[bool]:
+        """
+        Match the table names from the database against the tables this browser requires
+
+        Returns None if the detector is a custom query, which can't be matched this way
+        """
+        required = detector_tables(cls.detector)
+        if required is None:
+            return None
+        return required <= tables
+
     @classmethod
     def detect(cls, path: PathIshOrConn) -> bool:
         """
         Run the detector against the given path/connection to detect if the current Browser matches the schema
         """
-        # if the user provided something that had spaces - is a query
-        if " " in cls.detector.strip():
-            detector_query = cls.detector
-        else:
-            detector_query = f"SELECT * FROM {cls.detector}"
+        matched = cls.detect_tables(list_tables(path))
+        if matched is not None:
+            logger.debug(f"{cls.__name__}: Matched tables against detector: {matched}")
+            return matched
+        # some other query, have to run it to check if it succeeds
+        detector_query = cls.detector
         logger.debug(f"{cls.__name__}: Running detector query '{detector_query}'")
         try:
             list(execute_query(path, detector_query))
@@ -69,12 +239,104 @@ class Browser:
             return False
 
     @classmethod
-    def extract_visits(cls, path: PathIshOrConn) -> Iterator[Visit]:
+    def extract_visits(
+        cls, path: PathIshOrConn, options: Optional[ExtractOptions] = None
+    ) -> Iterator[Visit]:
         """
         Given a path or a sqlite3 connection, extract visits
         """
         raise NotImplementedError
 
+    @classmethod
+    def extract_batches(
+        cls,
+        path: PathIshOrConn,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        options: Optional[ExtractOptions] = None,
+    ) -> Iterator[VisitBatch]:
+        """
+        Extract visits in columnar batches. By default this groups the
+        visits from extract_visits, browsers can override this
+        to build the columns from the rows directly
+        """
+        if options is None:
+            visits = cls.extract_visits(path)
+        else:
+            visits = cls.extract_visits(path, options)
+        yield from batches_from_visits(visits, batch_size)
+
+    @classmethod
+    def time_condition(
+        cls, since: Optional[Microsecond], until: Optional[Microsecond]
+    ) -> Optional[str]:
+        """
+        Given a range of unix timestamps (in microseconds), return a condition for the
+        WHERE clause in this browser's native timestamp format, so the visit
+        time index can be used. Returns None if this browser doesn't support it
+        """
+        return None
+
+    @classmethod
+    def build_query(
+        cls, options: Optional[ExtractOptions] = None
+    ) -> Tuple[str, Params]:
+        """
+        Build the query (and parameters) for the schema, pushing any filters into the WHERE clause
+        """
+        schema = cls.schema  # type: ignore[misc]
+        if options is None:
+            return schema.query, ()
+        conditions: List[str] = []
+        params: List[Any] = []
+        if options.filters_time:
+            cond = cls.time_condition(*options.time_range())
+            if cond is None:
+                raise BrowserexportError(
+                    f"{cls.__name__} doesn't support filtering by visit time"
+                )
+            conditions.append(cond)
+        if options.url_like is not None:
+            if schema.url_col is None:
+                raise BrowserexportError(
+                    f"{cls.__name__} doesn't support filtering by url"
+                )
+            conditions.append(f"{schema.url_col} LIKE ?")
+            params.append(options.url_like)
+        if options.after_id is not None:
+            if schema.id_col is None:
+                raise BrowserexportError(
+                    f"{cls.__name__} doesn't support filtering by visit id"
+                )
+            # usually only a few new visits, so look them up by id instead of
+            # scanning the visit time index (which is used for the ORDER BY)
+            conditions.append(f"unlikely({schema.id_col} > ?)")
+            params.append(options.after_id)
+        return schema.build_query(conditions, metadata=options.metadata), params
+
+    @classmethod
+    def max_visit_id(cls, path: PathIshOrConn) -> Optional[int]:
+        """
+        The largest visit id (Schema.id_col), None if this browser doesn't
+        have an id column or there are no visits
+        """
+        schema = cls.schema  # type: ignore[misc]
+        if schema.id_col is None:
+            return None
+        # instead of MAX(), so sqlite can read the visit table backwards by its primary key
+        query = f"SELECT {schema.id_col} {schema.where} ORDER BY {schema.id_col} DESC LIMIT 1"
+        rows = list(execute_query(path, query))
+        return cast(Optional[int], rows[0][0]) if rows else None
+
+    @classmethod
+    def visit_row(cls, path: PathIshOrConn, visit_id: int) -> Optional[Tuple[Any, ...]]:
+        """
+        The (raw) columns selected for the visit with this id, None if it doesn't exist
+        """
+        schema = cls.schema  # type: ignore[misc]
+        query = schema.build_query([f"{schema.id_col} = ?"], metadata=False)
+        rows = list(execute_query(path, query, (visit_id,)))
+        return tuple(rows[0]) if rows else None
+
     @classmethod
     def data_directories(cls) -> Paths:
         """
@@ -89,18 +351,55 @@ class Browser:
         """
         raise NotImplementedError
 
+    @classmethod
+    def locate_databases(cls, profile: str = "*") -> List[Path]:
+        """
+        Locate every database matching the profile (for browsers with multiple
+        profiles), instead of requiring the profile to match exactly one
+        """
+        return [cls.locate_database(profile)]
+
 
 def from_datetime_microseconds(ts: int) -> datetime:
     return datetime.fromtimestamp(ts / 1_000_000, tz=timezone.utc)
 
 
+UnquoteById = Callable[[int, str], str]
+
+
+def unquote_by_id() -> UnquoteById:
+    """
+    Returns a function which unquotes a URL, given the id of the row it came from
+
+    The same URL is repeated for every visit to a page, so this only unquotes each
+    distinct URL once, and every visit shares the same string object.
+    Should be created once per database, since the ids are only unique within one database
+    """
+    cache: Dict[int, str] = {}
+
+    def _unquote(url_id: int, url: str) -> str:
+        res = cache.get(url_id)
+        if res is None:
+            res = cache[url_id] = unquote(url)
+        return res
+
+    return _unquote
+
+
 errmsg = """Expected to match a single database, but found:
 {}
 
-You can use the --profile argument to select one of the profiles/match a particular file"""
+You can use the --profile argument to select one of the profiles/match a particular file,
+or 'save --all-profiles' to back up all of them"""
 
 
-def handle_glob(bases: Sequence[Path], stem: str, recursive: bool = False) -> Path:
+def glob_databases(
+    bases: Sequence[Path], stem: str, recursive: bool = False
+) -> List[Path]:
+    """
+    All the databases matching stem in the bases. If nothing matches, searches
+    recursively as a fallback
+    """
     glob_itrs: List[Generator[Path, None, None]]
     if recursive:  # bleh, split like this to make mypy happy
         glob_itrs = [base.rglob(stem) for base in bases]
@@ -109,6 +408,13 @@ def handle_glob(bases: Sequence[Path], stem: str, recursive: bool = False) -> Pa
     dbs: List[Path] = list(chain(*glob_itrs))
     recur_desc = "recursive" if recursive else "non recursive"
     logger.debug(f"Glob {bases} with {stem} ({recur_desc}) matched {dbs}")
+    if not dbs and not recursive:
+        return glob_databases(bases, stem, recursive=True)
+    return dbs
+
+
+def handle_glob(bases: Sequence[Path], stem: str, recursive: bool = False) -> Path:
+    dbs: List[Path] = glob_databases(bases, stem, recursive=recursive)
     if len(dbs) > 1:
         human_readable_db_paths: str = "\n".join([str(db) for db in dbs])
         raise BrowserexportError(errmsg.format(human_readable_db_paths))
@@ -116,18 +422,14 @@ def handle_glob(bases: Sequence[Path], stem: str, recursive: bool = False) -> Pa
         # found the match!
         return dbs[0]
     else:
-        # if we weren't trying to search recursively, try a recursive search as a fallback
-        if not recursive:
-            return handle_glob(bases, stem, recursive=True)
-        else:
-            import shlex
+        import shlex
 
-            raise BrowserexportError(
-                "Could not find database, using bases: '{bases}' and profile '{stem}'".format(
-                    bases=", ".join(f'"{shlex.quote(str(base))}"' for base in bases),
-                    stem=stem,
-                )
+        raise BrowserexportError(
+            "Could not find database, using bases: '{bases}' and profile '{stem}'".format(
+                bases=", ".join(f'"{shlex.quote(str(base))}"' for base in bases),
+                stem=stem,
             )
+        )
 
 
 PROCFILE = Path("/proc/version")
@@ -12,10 +12,21 @@ from .common import (
     windows_appdata_paths,
     Schema,
     execute_query,
-    from_datetime_microseconds,
     handle_glob,
+    glob_databases,
+    List,
     handle_path,
     Paths,
+    ExtractOptions,
+    Microsecond,
+    range_condition,
+    extracts_metadata,
+    unquote_by_id,
+    DEFAULT_BATCH_SIZE,
+    VisitBatch,
+    execute_query_batched,
+    columns,
+    micros_array,
 )
 
 T = TypeVar("T")
@@ -28,36 +39,93 @@ def func_if_some(maybe: Optional[T], func: Callable[[T], T]) -> Optional[T]:
     return maybe
 
 
+MICROS_THRESHOLD = 300_000_000 * 1_000_000
+
+
+def _ceil_millis(us: Microsecond) -> Microsecond:
+    # the first millisecond value at or after this microsecond timestamp
+    return -(-us // 1000)
+
+
 class Firefox(Browser):
     detector = "SELECT * FROM moz_meta, moz_annos"
     schema = Schema(
         cols=[
             "P.url",
+            "P.id AS place_id",
             # Hack to tell apart whether timestamp is stored in microseconds (on desktop) or in milliseconds (on mobile)
             # We set 300_000_000 as threshold, it's year 1979, so definitely before Firefox existed,
             # and the same multiplied by 1000 is year 11476, also enough time for us not to care.
             "(CASE WHEN (V.visit_date > 300000000 * 1000000) THEN V.visit_date ELSE V.visit_date * 1000 END) AS visit_date",
             "V.visit_date",
+        ],
+        metadata_cols=[
             "P.title",
             "P.description",
             "P.preview_image_url",
         ],
         where="FROM moz_historyvisits as V, moz_places as P WHERE V.place_id = P.id",
         order_by="V.visit_date",
+        url_col="P.url",
+        id_col="V.id",
     )
 
     @classmethod
-    def extract_visits(cls, path: PathIshOrConn) -> Iterator[Visit]:
-        for row in execute_query(path, cls.schema.query):
-            yield Visit(
-                url=unquote(row["url"]),
-                dt=from_datetime_microseconds(row["visit_date"]),
-                metadata=Metadata.make(
+    def time_condition(
+        cls, since: Optional[Microsecond], until: Optional[Microsecond]
+    ) -> Optional[str]:
+        # visit_date could be microseconds (desktop) or milliseconds (mobile), so check
+        # both ranges, split at the same threshold as the CASE above
+        micros = range_condition("V.visit_date", since, until)
+        millis = range_condition(
+            "V.visit_date",
+            func_if_some(since, _ceil_millis),
+            func_if_some(until, _ceil_millis),
+        )
+        return f"(V.visit_date > {MICROS_THRESHOLD} AND {micros}) OR (V.visit_date <= {MICROS_THRESHOLD} AND {millis})"
+
+    @classmethod
+    def extract_visits(
+        cls, path: PathIshOrConn, options: Optional[ExtractOptions] = None
+    ) -> Iterator[Visit]:
+        query, params = cls.build_query(options)
+        metadata = extracts_metadata(options)
+        unquote_url = unquote_by_id()
+        for row in execute_query(path, query, params):
+            url = unquote_url(row["place_id"], row["url"])
+            md: Optional[Metadata] = None
+            if metadata:
+                md = Metadata.make(
                     title=row["title"],
                     description=row["description"],
                     preview_image=func_if_some(row["preview_image_url"], unquote),
-                ),
+                )
+            # visit_date is converted to microseconds in the query
+            yield Visit.from_micros(url, row["visit_date"], md)
+
+    @classmethod
+    def extract_batches(
+        cls,
+        path: PathIshOrConn,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        options: Optional[ExtractOptions] = None,
+    ) -> Iterator[VisitBatch]:
+        query, params = cls.build_query(options)
+        metadata = extracts_metadata(options)
+        unquote_url = unquote_by_id()
+        for rows in execute_query_batched(path, query, params, batch_size=batch_size):
+            cols = columns(rows)
+            batch = VisitBatch(
+                urls=list(map(unquote_url, cols["place_id"], cols["url"])),
+                timestamps=micros_array(cols["visit_date"]),
             )
+            if metadata:
+                batch.titles = list(cols["title"])
+                batch.descriptions = list(cols["description"])
+                batch.preview_images = [
+                    func_if_some(img, unquote) for img in cols["preview_image_url"]
+                ]
+            yield batch
 
     @classmethod
     def data_directories(cls) -> Paths:
@@ -78,3 +146,7 @@ class Firefox(Browser):
     def locate_database(cls, profile: str = "*") -> Path:
         dd = cls.data_directories()
         return handle_glob(dd, profile + "/places.sqlite")
+
+    @classmethod
+    def locate_databases(cls, profile: str = "*") -> List[Path]:
+        return glob_databases(cls.data_directories(), profile + "/places.sqlite")
@@ -9,8 +9,12 @@ from .common import (
     Path,
     Schema,
     execute_query,
-    from_datetime_microseconds,
     Paths,
+    Optional,
+    ExtractOptions,
+    Microsecond,
+    range_condition,
+    extracts_metadata,
 )
 
 
@@ -25,24 +29,31 @@ class FirefoxMobileLegacy(Browser):
         cols=[
             "H.url",
             "V.date",
-            "H.title",
         ],
+        metadata_cols=["H.title"],
         where="FROM visits as V, history as H WHERE V.history_guid = H.guid",
         order_by="V.date",
+        url_col="H.url",
         # todo: bookmarks, searchhistory tables might be interesting
     )
     has_save = False
 
     @classmethod
-    def extract_visits(cls, path: PathIshOrConn) -> Iterator[Visit]:
-        for row in execute_query(path, cls.schema.query):
-            yield Visit(
-                url=unquote(row["url"]),
-                dt=from_datetime_microseconds(row["date"]),
-                metadata=Metadata.make(
-                    title=row["title"],
-                ),
-            )
+    def time_condition(
+        cls, since: Optional[Microsecond], until: Optional[Microsecond]
+    ) -> Optional[str]:
+        return range_condition("V.date", since, until)
+
+    @classmethod
+    def extract_visits(
+        cls, path: PathIshOrConn, options: Optional[ExtractOptions] = None
+    ) -> Iterator[Visit]:
+        query, params = cls.build_query(options)
+        metadata = extracts_metadata(options)
+        for row in execute_query(path, query, params):
+            url = unquote(row["url"])
+            md = Metadata.make(title=row["title"]) if metadata else None
+            yield Visit.from_micros(url, row["date"], md)
 
     @classmethod
     def data_directories(cls) -> Paths:
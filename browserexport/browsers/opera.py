@@ -6,6 +6,8 @@ from .common import (
     handle_path,
     windows_appdata_paths,
     handle_glob,
+    glob_databases,
+    List,
     Path,
 )
 
@@ -55,3 +57,12 @@ class Opera(Chrome):
 
         assert err is not None
         raise err
+
+    @classmethod
+    def locate_databases(cls, profile: str = "*") -> List[Path]:
+        dd = cls.data_directories()
+        for pth in ("/History", "History"):
+            dbs = glob_databases(dd, profile + pth)
+            if dbs:
+                return dbs
+        return []
@@ -1,5 +1,3 @@
-from urllib.parse import unquote
-
 from .common import (
     Path,
     Schema,
@@ -7,14 +5,21 @@ from .common import (
     Visit,
     Browser,
     Metadata,
-    from_datetime_microseconds,
     execute_query,
     handle_path,
     handle_glob,
+    glob_databases,
+    List,
     Paths,
     PathIshOrConn,
-    sqlite3,
+    Optional,
+    Tables,
     logger,
+    ExtractOptions,
+    Microsecond,
+    range_condition,
+    extracts_metadata,
+    unquote_by_id,
 )
 
 
@@ -27,45 +32,52 @@ class Palemoon(Browser):
     detector = "moz_historyvisits"
 
     @classmethod
-    def detect(cls, path: PathIshOrConn) -> bool:
+    def detect_tables(cls, tables: Tables) -> Optional[bool]:
         # if this doesn't have the moz_historyvisits, exit
-        if not super().detect(path):
+        if "moz_historyvisits" not in tables:
             return False
-        try:
-            # Palemoon doesn't have the moz_meta table, so can use that
-            # to make sure this is palemoon and not some other firefox derivative?
-            logger.debug(
-                "May be Palemoon, running query on moz_meta to ensure this isn't another Firefox derivative"
-            )
-            list(execute_query(path, "Select * FROM moz_meta"))
-            logger.debug("'moz_meta' query failed, not Palemoon")
+        # Palemoon doesn't have the moz_meta table, so can use that
+        # to make sure this is palemoon and not some other firefox derivative
+        if "moz_meta" in tables:
+            logger.debug("'moz_meta' exists, not Palemoon")
             return False
-        except sqlite3.OperationalError:
-            logger.debug(
-                "moz_historyvisits exists but moz_meta doesn't, detected as Palemoon"
-            )
-            return True
+        logger.debug(
+            "moz_historyvisits exists but moz_meta doesn't, detected as Palemoon"
+        )
+        return True
 
     # seems to store less info that firefox schema
     # no description or preview_image
     schema = Schema(
         cols=[
             "P.url",
+            "P.id AS place_id",
             "V.visit_date",
-            "P.title",
         ],
+        metadata_cols=["P.title"],
         where="FROM moz_historyvisits as V, moz_places as P WHERE V.place_id = P.id",
         order_by="V.visit_date",
+        url_col="P.url",
+        id_col="V.id",
     )
 
     @classmethod
-    def extract_visits(cls, path: PathIshOrConn) -> Iterator[Visit]:
-        for row in execute_query(path, cls.schema.query):
-            yield Visit(
-                url=unquote(row["url"]),
-                dt=from_datetime_microseconds(row["visit_date"]),
-                metadata=Metadata.make(title=row["title"]),
-            )
+    def time_condition(
+        cls, since: Optional[Microsecond], until: Optional[Microsecond]
+    ) -> Optional[str]:
+        return range_condition("V.visit_date", since, until)
+
+    @classmethod
+    def extract_visits(
+        cls, path: PathIshOrConn, options: Optional[ExtractOptions] = None
+    ) -> Iterator[Visit]:
+        query, params = cls.build_query(options)
+        metadata = extracts_metadata(options)
+        unquote_url = unquote_by_id()
+        for row in execute_query(path, query, params):
+            url = unquote_url(row["place_id"], row["url"])
+            md = Metadata.make(title=row["title"]) if metadata else None
+            yield Visit.from_micros(url, row["visit_date"], md)
 
     # seems the non-linux community is pretty small?
     # https://forum.palemoon.org/viewforum.php?f=41
@@ -85,3 +97,7 @@ class Palemoon(Browser):
     def locate_database(cls, profile: str = "*") -> Path:
         dd = cls.data_directories()
         return handle_glob(dd, profile + "/places.sqlite")
+
+    @classmethod
+    def locate_databases(cls, profile: str = "*") -> List[Path]:
+        return glob_databases(cls.data_directories(), profile + "/places.sqlite")
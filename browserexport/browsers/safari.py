@@ -1,5 +1,3 @@
-from urllib.parse import unquote
-
 from .common import (
     Iterator,
     Visit,
@@ -8,12 +6,24 @@ from .common import (
     Browser,
     Schema,
     Path,
-    datetime,
-    timezone,
     execute_query,
     handle_glob,
+    glob_databases,
+    List,
     handle_path,
     Paths,
+    Optional,
+    ExtractOptions,
+    Microsecond,
+    range_condition,
+    extracts_metadata,
+    timestamp_to_micros,
+    DEFAULT_BATCH_SIZE,
+    VisitBatch,
+    execute_query_batched,
+    columns,
+    seconds_to_micros,
+    unquote_by_id,
 )
 
 # Referenced:
@@ -21,9 +31,18 @@ from .common import (
 # https://web.archive.org/web/20201026130310/http://fileformats.archiveteam.org/wiki/History.db
 
 
-def _safari_date_to_utc(safari_time: int) -> datetime:
-    ts = safari_time + 978307200
-    return datetime.fromtimestamp(ts, tz=timezone.utc)
+SAFARI_EPOCH_OFFSET = 978307200
+
+
+def _safari_date_to_micros(safari_time: float) -> Microsecond:
+    return timestamp_to_micros(safari_time + SAFARI_EPOCH_OFFSET)
+
+
+def _utc_to_safari_date(us: Optional[Microsecond]) -> Optional[float]:
+    # safari stores seconds (as a float) since 2001-01-01
+    if us is None:
+        return None
+    return us / 1_000_000 - SAFARI_EPOCH_OFFSET
 
 
 class Safari(Browser):
@@ -32,21 +51,55 @@ class Safari(Browser):
     schema = Schema(
         cols=[
             "U.url",
+            "U.id AS item_id",
             "V.visit_time",
-            "V.title",
         ],
+        metadata_cols=["V.title"],
         where="FROM history_visits as V, history_items as U WHERE V.history_item = U.id",
         order_by="V.visit_time",
+        url_col="U.url",
+        id_col="V.id",
     )
 
     @classmethod
-    def extract_visits(cls, path: PathIshOrConn) -> Iterator[Visit]:
-        for row in execute_query(path, cls.schema.query):
-            yield Visit(
-                url=unquote(row["url"]),
-                dt=_safari_date_to_utc(row["visit_time"]),
-                metadata=Metadata.make(title=row["title"]),
+    def time_condition(
+        cls, since: Optional[Microsecond], until: Optional[Microsecond]
+    ) -> Optional[str]:
+        return range_condition(
+            "V.visit_time", _utc_to_safari_date(since), _utc_to_safari_date(until)
+        )
+
+    @classmethod
+    def extract_visits(
+        cls, path: PathIshOrConn, options: Optional[ExtractOptions] = None
+    ) -> Iterator[Visit]:
+        query, params = cls.build_query(options)
+        metadata = extracts_metadata(options)
+        unquote_url = unquote_by_id()
+        for row in execute_query(path, query, params):
+            url = unquote_url(row["item_id"], row["url"])
+            md = Metadata.make(title=row["title"]) if metadata else None
+            yield Visit.from_micros(url, _safari_date_to_micros(row["visit_time"]), md)
+
+    @classmethod
+    def extract_batches(
+        cls,
+        path: PathIshOrConn,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        options: Optional[ExtractOptions] = None,
+    ) -> Iterator[VisitBatch]:
+        query, params = cls.build_query(options)
+        metadata = extracts_metadata(options)
+        unquote_url = unquote_by_id()
+        for rows in execute_query_batched(path, query, params, batch_size=batch_size):
+            cols = columns(rows)
+            batch = VisitBatch(
+                urls=list(map(unquote_url, cols["item_id"], cols["url"])),
+                timestamps=seconds_to_micros(cols["visit_time"], SAFARI_EPOCH_OFFSET),
             )
+            if metadata:
+                batch.titles = list(cols["title"])
+            yield batch
 
     @classmethod
     def data_directories(cls) -> Paths:
@@ -62,3 +115,7 @@ class Safari(Browser):
     def locate_database(cls, profile: str = "*") -> Path:
         dd = cls.data_directories()
         return handle_glob(dd, profile + "History.db")
+
+    @classmethod
+    def locate_databases(cls, profile: str = "*") -> List[Path]:
+        return glob_databases(cls.data_directories(), profile + "History.db")
@@ -1,4 +1,7 @@
-from typing import Union
+import os
+import json
+from datetime import datetime, timezone
+from typing import Union, Dict, Any
 from pathlib import Path
 from sqlite3 import Connection
 
@@ -16,3 +19,46 @@ def expand_path(path: PathIsh) -> Path:
 # keep as RuntimeError for backwards compatibility
 class BrowserexportError(RuntimeError):
     pass
+
+
+def state_dir() -> Path:
+    """
+    Directory to store state between runs (e.g. the last visit exported)
+    """
+    return expand_path(os.environ.get("XDG_STATE_HOME") or "~/.local/state") / (
+        "browserexport"
+    )
+
+
+def read_state_file(path: PathIsh, version: int) -> Dict[str, Any]:
+    """
+    Read a JSON state file written by write_state_file, returns an empty dict if it doesn't exist
+    """
+    p = expand_path(path)
+    if not p.exists():
+        return {}
+    try:
+        data = json.loads(p.read_text())
+    except ValueError as e:
+        raise BrowserexportError(f"Could not read state from {p}: {e}")
+    if not isinstance(data, dict) or data.get("version") != version:
+        raise BrowserexportError(f"{p} isn't a state file with version {version}")
+    return data
+
+
+def write_state_file(path: PathIsh, version: int, data: Dict[str, Any]) -> None:
+    p = expand_path(path)
+    p.parent.mkdir(parents=True, exist_ok=True)
+    tmp = p.with_name(p.name + ".tmp")
+    tmp.write_text(
+        json.dumps(
+            {
+                "version": version,
+                "updated": datetime.now(tz=timezone.utc).isoformat(),
+                **data,
+            },
+            indent=2,
+        )
+    )
+    # so a partially written file never replaces the previous state
+    os.replace(tmp, p)
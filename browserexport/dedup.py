@@ -0,0 +1,167 @@
+"""
+A memory-bounded index of (url, timestamp) keys, used to remove duplicate visits
+"""
+
+import os
+import sys
+import sqlite3
+import tempfile
+from types import TracebackType
+from typing import List, Optional, Sequence, Set, Tuple, Type
+
+from .log import logger
+
+Key = Tuple[str, int]
+
+# size of the tuple for each key in the in-memory set, the url and the timestamp
+# are measured with sys.getsizeof, the set itself as well
+KEY_SIZE = sys.getsizeof(("", 0))
+
+# how many keys merge_visits adds at once, so the keys on disk are checked in batches
+BATCH_SIZE = 10_000
+
+# the keys on disk are indexed by their fingerprint, the url/timestamp are
+# compared as well, so two keys with the same fingerprint are never confused
+SPILL_SCHEMA = """
+CREATE TABLE seen (hi INTEGER NOT NULL, lo INTEGER NOT NULL, url TEXT NOT NULL, ts INTEGER NOT NULL);
+CREATE INDEX seen_fingerprint ON seen (hi, lo);
+CREATE TEMP TABLE batch (idx INTEGER PRIMARY KEY, hi INTEGER NOT NULL, lo INTEGER NOT NULL, url TEXT NOT NULL, ts INTEGER NOT NULL);
+"""
+
+LOOKUP_QUERY = """
+SELECT b.idx FROM batch b JOIN seen s
+ON s.hi = b.hi AND s.lo = b.lo AND s.url = b.url AND s.ts = b.ts
+"""
+
+_MASK = (1 << 64) - 1
+
+
+def fingerprint(url: str, ts: int) -> int:
+    """
+    A 128-bit fingerprint of the key, made of two independent 64-bit hashes
+    (hashing a different string gives an unrelated hash). Like hash(), this is
+    only the same within one process
+    """
+    return (hash((url, ts)) << 64) | (hash((url + "\0", ts)) & _MASK)
+
+
+def _split(fp: int) -> Tuple[int, int]:
+    # sqlite integers are signed 64-bit, so store each half separately
+    lo = fp & _MASK
+    return fp >> 64, lo - (1 << 64) if lo >> 63 else lo
+
+
+class VisitKeyIndex:
+    """
+    Tracks which (url, timestamp) keys have already been seen
+
+    The keys are kept in memory until they use roughly 'max_memory' bytes, after
+    which they're written to a temporary sqlite database, indexed by a fingerprint
+    of each key. Keys are added in batches (see add_many), so the keys on disk
+    are checked with one query per batch, instead of one per key
+
+    Keys are always compared exactly, so this removes the same duplicates as a set would
+    """
+
+    def __init__(self, max_memory: int, tempdir: Optional[str] = None) -> None:
+        self.max_memory = max_memory
+        self.tempdir = tempdir
+        self._keys: Set[Key] = set()
+        self._keys_size = 0
+        self._spill: Optional[sqlite3.Connection] = None
+        self._spill_dir: "Optional[tempfile.TemporaryDirectory[str]]" = None
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def memory_used(self) -> int:
+        """
+        Approximate bytes used by the keys in memory
+        """
+        return sys.getsizeof(self._keys) + self._keys_size
+
+    def _spilled(self, candidates: Sequence[Tuple[int, Key]]) -> Set[int]:
+        """
+        Given (index, key) for keys which aren't in memory,
+        returns the indexes of the ones which have been written to disk
+        """
+        if self._spill is None or not candidates:
+            return set()
+        with self._spill:
+            self._spill.execute("DELETE FROM batch")
+            self._spill.executemany(
+                "INSERT INTO batch VALUES (?, ?, ?, ?, ?)",
+                ((i, *_split(fingerprint(*key)), *key) for i, key in candidates),
+            )
+        return {i for i, in self._spill.execute(LOOKUP_QUERY)}
+
+    def _spill_keys(self) -> None:
+        if self._spill is None:
+            self._spill_dir = tempfile.TemporaryDirectory(
+                prefix="browserexport-dedup-", dir=self.tempdir
+            )
+            spill_path = os.path.join(self._spill_dir.name, "keys.sqlite")
+            logger.debug(f"Exceeded memory limit, spilling keys to {spill_path}")
+            self._spill = sqlite3.connect(spill_path)
+            self._spill.execute("PRAGMA journal_mode=OFF")
+            self._spill.execute("PRAGMA synchronous=OFF")
+            self._spill.execute("PRAGMA temp_store=memory")
+            self._spill.executescript(SPILL_SCHEMA)
+        count = len(self._keys)
+        with self._spill:
+            # sorted, so each page of the index is only written to once per spill.
+            # keys are only added if they weren't on disk already, so there are no duplicates
+            self._spill.executemany(
+                "INSERT INTO seen VALUES (?, ?, ?, ?)",
+                sorted((*_split(fingerprint(*key)), *key) for key in self._keys),
+            )
+        # a new set, since clearing doesn't shrink the existing one
+        self._keys = set()
+        self._keys_size = 0
+        logger.debug(f"Spilled {count} keys to disk")
+
+    def add_many(self, keys: Sequence[Key]) -> List[bool]:
+        """
+        Add the keys to the index. For each key, returns False if it
+        was already present (including earlier in keys)
+        """
+        mem = self._keys
+        spilled: Set[int] = set()
+        if self._spill is not None:
+            spilled = self._spilled(
+                [(i, key) for i, key in enumerate(keys) if key not in mem]
+            )
+        added: List[bool] = []
+        size = 0
+        for i, key in enumerate(keys):
+            if key in mem or i in spilled:
+                added.append(False)
+            else:
+                mem.add(key)
+                size += KEY_SIZE + sys.getsizeof(key[0]) + sys.getsizeof(key[1])
+                added.append(True)
+        self._keys_size += size
+        self._count += sum(added)
+        if self.memory_used() > self.max_memory:
+            self._spill_keys()
+        return added
+
+    def close(self) -> None:
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        if self._spill_dir is not None:
+            self._spill_dir.cleanup()
+            self._spill_dir = None
+
+    def __enter__(self) -> "VisitKeyIndex":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
@@ -0,0 +1,179 @@
+"""
+Export the visits added to a browser's current history database since the last
+export, without making a backup copy of the database first
+"""
+
+import sqlite3
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple, Type, Union
+
+from sqlite_backup import sqlite_backup
+
+from .log import logger
+from .common import PathIsh, expand_path, BrowserexportError
+from .common import state_dir, read_state_file, write_state_file
+from .model import Visit, Microsecond, micros_to_datetime
+from .sqlite import connect, list_tables
+from .parse import detect_browser
+from .merge import merge_visits
+from .write import write_json
+from .browsers.all import DEFAULT_BROWSERS
+from .browsers.common import Browser, ExtractOptions
+
+STATE_VERSION = 1
+
+# visit times are converted from each browser's format with some rounding, so
+# query a bit before the high-water mark, and compare the converted times instead
+TIME_SLACK = 10
+
+
+@dataclass
+class HighWaterMark:
+    """
+    The largest visit id, and the newest visit time, of the visits which have been exported
+    """
+
+    visit_id: int
+    visit_time: Microsecond
+    browser: str = ""
+
+
+State = Dict[str, HighWaterMark]
+
+
+def default_state_path() -> Path:
+    return state_dir() / "export-new.json"
+
+
+def load_state(path: PathIsh) -> State:
+    """
+    Read the high-water mark for each database, keyed by the database path
+    """
+    data = read_state_file(path, STATE_VERSION)
+    try:
+        return {
+            db: HighWaterMark(**mark) for db, mark in data.get("databases", {}).items()
+        }
+    except TypeError as e:
+        raise BrowserexportError(f"Could not read state from {path}: {e}")
+
+
+def save_state(path: PathIsh, state: State) -> None:
+    write_state_file(
+        path,
+        STATE_VERSION,
+        {"databases": {db: asdict(mark) for db, mark in state.items()}},
+    )
+
+
+@contextmanager
+def open_live(path: PathIsh) -> Iterator[sqlite3.Connection]:
+    """
+    Open a database which may be in use by the browser, read-only. All reads
+    happen in a single transaction, so they see the same version of the database
+
+    If the browser has the database locked, falls back to copying it into memory
+    """
+    conn: Optional[sqlite3.Connection] = None
+    try:
+        conn = connect(path, live=True)
+        conn.execute("BEGIN")
+        # the first read acquires the lock, or fails if the database is locked
+        list_tables(conn)
+    except sqlite3.OperationalError as e:
+        if conn is not None:
+            conn.close()
+        if "locked" not in str(e):
+            raise
+        logger.warning(f"{path} is locked ({e}), copying it into memory instead")
+        copied = sqlite_backup(path, wal_checkpoint=False, copy_use_tempdir=True)
+        assert copied is not None
+        conn = copied
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def read_new_visits(
+    browser: Type[Browser],
+    conn: sqlite3.Connection,
+    mark: Optional[HighWaterMark],
+) -> Tuple[List[Visit], HighWaterMark]:
+    """
+    Read the visits newer than the high-water mark (all of them if there is none)
+
+    That includes visits with a larger id, and any visits with a newer visit time,
+    in case the newest visits were deleted and their ids were reused.
+    Returns the visits (sorted by time) and the new high-water mark
+    """
+    max_id = browser.max_visit_id(conn)
+    if max_id is None and browser.schema.id_col is None:  # type: ignore[misc]
+        raise BrowserexportError(
+            f"{browser.__name__} doesn't support exporting new visits"
+        )
+    visits: List[Visit]
+    if mark is None:
+        visits = list(browser.extract_visits(conn))
+    else:
+        by_id = browser.extract_visits(conn, ExtractOptions(after_id=mark.visit_id))
+        since = micros_to_datetime(mark.visit_time - TIME_SLACK)
+        by_time = (
+            v
+            for v in browser.extract_visits(conn, ExtractOptions(since=since))
+            if v.ts > mark.visit_time
+        )
+        visits = list(merge_visits([by_id, by_time], sorted=True))
+    newest = max((v.ts for v in visits), default=0)
+    return visits, HighWaterMark(
+        visit_id=max_id or 0,
+        visit_time=max(newest, mark.visit_time if mark is not None else 0),
+        browser=browser.__name__.lower(),
+    )
+
+
+def export_new(
+    browser: Union[str, Type[Browser], None],
+    out: BinaryIO,
+    *,
+    profile: str = "*",
+    path: Optional[PathIsh] = None,
+    state_path: Optional[PathIsh] = None,
+) -> int:
+    """
+    Write the visits added since the last export as JSON lines to out, and
+    update the high-water mark for the database in the state file
+
+    The database is located from the browser and profile (like 'save'), or
+    pass path to use a specific database (the browser is detected if not given).
+    Returns the number of visits written
+    """
+    from .save import _pick_browser
+
+    chosen: Optional[Type[Browser]] = None
+    if browser is not None:
+        chosen, _ = _pick_browser(browser)
+    if path is not None:
+        src = expand_path(path)
+    elif chosen is not None:
+        src = chosen.locate_database(profile)
+    else:
+        raise BrowserexportError("Must provide a browser or a path to a database")
+    state_file = expand_path(state_path) if state_path else default_state_path()
+    state = load_state(state_file)
+    key = str(src)
+    mark = state.get(key)
+
+    with open_live(src) as conn:
+        if chosen is None:
+            chosen = detect_browser(conn, DEFAULT_BROWSERS)
+        visits, state[key] = read_new_visits(chosen, conn, mark)
+
+    count = write_json(visits, out, lines=True)
+    out.flush()
+    # only update the state once the visits have been written
+    save_state(state_file, state)
+    logger.info(f"Exported {count} new visits from {src}")
+    return count
@@ -2,37 +2,275 @@
 Merges multiple history sqlite databases into one
 """
 
-from datetime import datetime
-from typing import Iterator, Iterable, Sequence, Set, Tuple, List
+import heapq
+import sqlite3
+from itertools import islice
+from dataclasses import asdict, dataclass, replace
+from pathlib import Path
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from typing import (
+    Iterator,
+    Iterable,
+    Sequence,
+    Set,
+    Tuple,
+    List,
+    Dict,
+    Optional,
+    Union,
+    Type,
+    Any,
+)
 
 from .log import logger
-from .model import Visit
-from .common import PathIsh, expand_path
-from .parse import read_visits
+from .model import Visit, Microsecond
+from .common import PathIsh, PathIshOrConn, expand_path, BrowserexportError
+from .parse import (
+    read_visits,
+    detect_browser,
+    _detect_extensions,
+    _compressed_sqlite_opener,
+    KNOWN_FORMATS,
+)
+from .sqlite import connect
+from .browsers.common import ExtractOptions, Browser
+from .browsers.all import DEFAULT_BROWSERS
+from .dedup import VisitKeyIndex, BATCH_SIZE
 
 
-def read_and_merge(paths: Sequence[PathIsh]) -> Iterator[Visit]:
+def read_and_merge(
+    paths: Sequence[PathIsh],
+    *,
+    workers: Optional[int] = None,
+    max_memory: Optional[int] = None,
+    sorted: bool = False,
+    options: Optional[ExtractOptions] = None,
+    snapshots: bool = False,
+) -> Iterator[Visit]:
     """
     Receives any amount of Path-like databases as input,
     reads Visits from each of those databases,
     and merges them together (removing duplicates)
+
+    If workers is greater than 1, reads the databases in parallel
+    using a process pool. The resulting order is the same as the serial version
+
+    options are passed to read_visits, to filter the visits read from each database
+
+    If snapshots is True, the paths are treated as backups of the same
+    profiles, see snapshot_options
+
+    See merge_visits for max_memory and sorted
     """
     pths = [expand_path(p) for p in paths]
-    hst: List[Iterator[Visit]] = list(map(read_visits, pths))
-    yield from merge_visits(hst)
+    src_options: List[Optional[ExtractOptions]] = (
+        snapshot_options(pths, options) if snapshots else [options] * len(pths)
+    )
+    if workers is None or workers <= 1:
+        hst: List[Iterator[Visit]] = [
+            _read_visits(p, opts) for p, opts in zip(pths, src_options)
+        ]
+        yield from merge_visits(hst, max_memory=max_memory, sorted=sorted)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from merge_visits(
+            parallel_sources(
+                executor, pths, prefetch=workers, source_options=src_options
+            ),
+            max_memory=max_memory,
+            sorted=sorted,
+        )
+
+
+@dataclass
+class _Snapshot:
+    path: Path
+    browser: Type[Browser]
+    # the largest visit id, and that row, to check if a later snapshot continues this one
+    max_id: int
+    last_row: Tuple[Any, ...]
+
+
+def _read_snapshot(path: Path) -> Optional[_Snapshot]:
+    """
+    Detect the browser and read the largest visit id, returns None if this
+    isn't a database (or the browser doesn't have an id column)
+    """
+    if _detect_extensions(path) in KNOWN_FORMATS or _compressed_sqlite_opener(path):
+        return None
+    conn = connect(path)
+    try:
+        browser = detect_browser(conn, DEFAULT_BROWSERS)
+        max_id = browser.max_visit_id(conn)
+        if max_id is None:
+            return None
+        last_row = browser.visit_row(conn, max_id)
+        assert last_row is not None
+        return _Snapshot(path, browser, max_id, last_row)
+    except (BrowserexportError, sqlite3.DatabaseError) as e:
+        # read it normally, which reports the error
+        logger.debug(f"{path}: {e}", exc_info=True)
+        return None
+    finally:
+        conn.close()
+
+
+def snapshot_options(
+    paths: Sequence[Path], options: Optional[ExtractOptions] = None
+) -> List[Optional[ExtractOptions]]:
+    """
+    For backups which are successive snapshots of the same profile, most of each
+    new backup is already in the previous one. This returns the options to read
+    each path with, so that only the visits which were added since the previous
+    snapshot are extracted
 
+    Databases are grouped by browser, and ordered by their largest visit id.
+    A database continues an earlier snapshot if it contains the same row at
+    that snapshot's largest visit id. Since browsers only add visits with
+    larger ids, the rows up to that id have already been read. If the row
+    was removed or changed (e.g. the most recent history was cleared, and
+    the ids were reused), the database is read completely instead
 
-def merge_visits(sources: Sequence[Iterable[Visit]]) -> Iterator[Visit]:
+    Other files (e.g. merged JSON dumps) are read with the given options
+    """
+    result: List[Optional[ExtractOptions]] = [options] * len(paths)
+    groups: Dict[Type[Browser], List[Tuple[int, _Snapshot]]] = {}
+    for i, p in enumerate(paths):
+        snap = _read_snapshot(p)
+        if snap is not None:
+            groups.setdefault(snap.browser, []).append((i, snap))
+    for browser, snaps in groups.items():
+        snaps.sort(key=lambda s: s[1].max_id)
+        # the latest snapshot of each lineage
+        latest: List[_Snapshot] = []
+        for i, snap in snaps:
+            prev = next(
+                (
+                    lt
+                    for lt in reversed(latest)
+                    if browser.visit_row(snap.path, lt.max_id) == lt.last_row
+                ),
+                None,
+            )
+            if prev is None:
+                latest.append(snap)
+                continue
+            logger.debug(
+                f"{snap.path} continues {prev.path}, reading visits after id {prev.max_id}"
+            )
+            latest[latest.index(prev)] = snap
+            result[i] = replace(options or ExtractOptions(), after_id=prev.max_id)
+    return result
+
+
+def _read_visits(
+    path: PathIshOrConn, options: Optional[ExtractOptions]
+) -> Iterator[Visit]:
+    if options is None:
+        return read_visits(path)
+    return read_visits(path, **asdict(options))
+
+
+def _read_visits_list(path: Path, options: Optional[ExtractOptions]) -> List[Visit]:
+    # runs in the worker process, the list is pickled and sent back to the main process
+    return list(_read_visits(path, options))
+
+
+Source = Union[Path, Iterable[Visit]]
+
+
+class _ParallelReader:
+    """
+    Submits paths to the executor, keeping at most 'prefetch' sources
+    extracted ahead of the one currently being consumed, so that
+    results don't pile up in memory if merging is slower than extracting
+    """
+
+    def __init__(
+        self,
+        executor: Executor,
+        sources: Sequence[Source],
+        prefetch: int,
+        source_options: Sequence[Optional[ExtractOptions]],
+    ) -> None:
+        self.executor = executor
+        self.sources = sources
+        self.prefetch = max(prefetch, 1)
+        self.source_options = source_options
+        self.futures: Dict[int, "Future[List[Visit]]"] = {}
+        self.submitted = 0
+
+    def _submit_until(self, index: int) -> None:
+        while self.submitted < min(index, len(self.sources)):
+            src = self.sources[self.submitted]
+            if isinstance(src, Path):
+                self.futures[self.submitted] = self.executor.submit(
+                    _read_visits_list, src, self.source_options[self.submitted]
+                )
+            self.submitted += 1
+
+    def visits(self, index: int) -> Iterator[Visit]:
+        self._submit_until(index + 1 + self.prefetch)
+        src = self.sources[index]
+        if isinstance(src, Path):
+            yield from self.futures.pop(index).result()
+        else:
+            yield from src
+
+
+def parallel_sources(
+    executor: Executor,
+    sources: Sequence[Source],
+    *,
+    prefetch: int,
+    options: Optional[ExtractOptions] = None,
+    source_options: Optional[Sequence[Optional[ExtractOptions]]] = None,
+) -> List[Iterator[Visit]]:
+    """
+    Extracts visits from any paths in sources using the executor. Other sources (e.g. visits
+    already being read from a connection) are consumed in the current process
+
+    source_options are the options for each source, if not given, options are used for every path
+
+    Returns one lazy iterator per source, in the same order as the input
+    """
+    if source_options is None:
+        source_options = [options] * len(sources)
+    reader = _ParallelReader(executor, sources, prefetch, source_options)
+    return [reader.visits(i) for i in range(len(sources))]
+
+
+def merge_visits(
+    sources: Sequence[Iterable[Visit]],
+    *,
+    max_memory: Optional[int] = None,
+    sorted: bool = False,
+) -> Iterator[Visit]:
     """
     Removes duplicate Visit items from multiple sources
+
+    If max_memory (in bytes) is given, the keys are written to a temporary
+    database on disk once they use more than max_memory, and checked against
+    in batches. The output is the same either way
+
+    If sorted is True, each source must already be sorted by visit time
+    (visits extracted from databases are). The sources are merged into a single
+    stream sorted by time, which means duplicates are always next to each
+    other, so only the visits at the current timestamp have to be remembered
     """
     logger.debug(f"merging information from {len(sources)} source(s)...")
-    # use combination of URL, visit date and visit type to uniquely identify visits
-    emitted: Set[Tuple[str, datetime]] = set()
+    if sorted:
+        yield from _merge_visits_sorted(sources)
+        return
+    if max_memory is not None:
+        yield from _merge_visits_bounded(sources, max_memory)
+        return
+    # use combination of URL and visit time (as an integer) to uniquely identify visits
+    emitted: Set[Tuple[str, Microsecond]] = set()
     duplicates = 0
     for src in sources:
         for vs in src:
-            key = (vs.url, vs.dt)
+            key = (vs.url, vs.ts)
             if key in emitted:
                 # logger.debug(f"skipping {key} => {vs}")
                 duplicates += 1
@@ -41,3 +279,62 @@ def merge_visits(sources: Sequence[Iterable[Visit]]) -> Iterator[Visit]:
             emitted.add(key)
     logger.debug("Summary: removed {} duplicates...".format(duplicates))
     logger.info("Summary: returning {} visit entries...".format(len(emitted)))
+
+
+def _merge_visits_bounded(
+    sources: Sequence[Iterable[Visit]], max_memory: int
+) -> Iterator[Visit]:
+    duplicates = 0
+    with VisitKeyIndex(max_memory) as index:
+        for src in sources:
+            it = iter(src)
+            while True:
+                batch = list(islice(it, BATCH_SIZE))
+                if not batch:
+                    break
+                added = index.add_many([(vs.url, vs.ts) for vs in batch])
+                for vs, new in zip(batch, added):
+                    if not new:
+                        duplicates += 1
+                        continue
+                    yield vs
+        logger.debug("Summary: removed {} duplicates...".format(duplicates))
+        logger.info("Summary: returning {} visit entries...".format(len(index)))
+
+
+def _visit_ts(vs: Visit) -> Microsecond:
+    return vs.ts
+
+
+def _check_sorted(src: Iterable[Visit], index: int) -> Iterator[Visit]:
+    prev: Optional[Visit] = None
+    for vs in src:
+        if prev is not None and vs.ts < prev.ts:
+            raise BrowserexportError(
+                f"Source {index} isn't sorted by visit time ({vs.dt} came after {prev.dt}), can't merge it in sorted mode"
+            )
+        prev = vs
+        yield vs
+
+
+def _merge_visits_sorted(sources: Sequence[Iterable[Visit]]) -> Iterator[Visit]:
+    duplicates = 0
+    count = 0
+    current: Optional[Microsecond] = None
+    # urls emitted at the current timestamp
+    seen: Set[str] = set()
+    for vs in heapq.merge(
+        *(_check_sorted(src, i) for i, src in enumerate(sources)), key=_visit_ts
+    ):
+        ts = vs.ts
+        if ts != current:
+            current = ts
+            seen.clear()
+        elif vs.url in seen:
+            duplicates += 1
+            continue
+        yield vs
+        seen.add(vs.url)
+        count += 1
+    logger.debug("Summary: removed {} duplicates...".format(duplicates))
+    logger.info("Summary: returning {} visit entries...".format(count))
@@ -1,34 +1,146 @@
 import os
+import re
+import json
 import sqlite3
+import bz2
+import gzip
+import lzma
+import time
 import tempfile
 import shutil
+from datetime import datetime
 from pathlib import Path
-from typing import Iterator, List, Any, Dict, TextIO, Optional, Type, BinaryIO
+from typing import (
+    Iterator,
+    List,
+    Any,
+    Dict,
+    TextIO,
+    Optional,
+    Type,
+    BinaryIO,
+    Callable,
+    cast,
+    Sequence,
+    TypeVar,
+    Tuple,
+    Union,
+)
 
 from kompress import is_compressed, CPath
 
 from .common import PathIshOrConn, PathIsh, expand_path, BrowserexportError
 from .model import Visit
 from .log import logger
+from .sqlite import list_tables, connect, ReadOptions
+from .archive import ARCHIVE_EXT, read_archive
+from .batch import VisitBatch, DEFAULT_BATCH_SIZE, batches_from_visits
 
-from .browsers.common import Browser
+from .browsers.common import Browser, ExtractOptions
 from .browsers.all import DEFAULT_BROWSERS
 
+JSON_CHUNK_SIZE = 1 << 20
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# how many times _decode_json_batch tries to end the batch at an earlier '}'
+JSON_BATCH_ATTEMPTS = 3
 
-def _read_json_obj(path: TextIO) -> Iterator[Dict[str, Any]]:
-    data: List[Dict[str, Any]]
-    try:
-        # speedup load using orjson if its installed
-        import orjson  # type: ignore[import]
 
-        data = orjson.loads(path.read())
+def _decode_json_batch(
+    loads: Callable[[str], Any], buf: str, pos: int
+) -> Optional[Tuple[List[Any], int]]:
+    """
+    Decodes all the complete objects in buf[pos:] at once, by wrapping them in a
+    list that ends after one of the last '}'s followed by a ',' or ']'. If that '}'
+    is inside a string or a nested value, the list isn't valid JSON, so this only
+    succeeds if it ended between the objects. Returns the objects and the end position
+    """
+    end = len(buf)
+    attempts = 0
+    while attempts < JSON_BATCH_ATTEMPTS:
+        end = buf.rfind("}", pos, end)
+        if end == -1:
+            return None
+        nxt = JSON_WHITESPACE.match(buf, end + 1).end()  # type: ignore[union-attr]
+        if nxt == len(buf) or buf[nxt] not in ",]":
+            continue
+        attempts += 1
+        try:
+            return loads("[" + buf[pos : end + 1] + "]"), end + 1
+        except ValueError:
+            pass
+    return None
 
-    except ImportError:
-        import json
 
-        data = json.loads(path.read())
+def _read_json_obj(
+    fp: TextIO, chunk_size: int = JSON_CHUNK_SIZE
+) -> Iterator[Dict[str, Any]]:
+    """
+    Incrementally parses a JSON list of objects, reading the file in chunks
+    and yielding each object as soon as it has been decoded, so the
+    entire file is never loaded into memory at once
 
-    yield from data
+    If orjson is installed, the complete objects in each chunk are decoded with it
+    """
+    loads: Optional[Callable[[str], Any]] = None
+    try:
+        import orjson  # type: ignore[import]
+
+        loads = orjson.loads
+    except ImportError:
+        pass
+
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    # what we expect next: the opening '[', a value (or ']' if the list is empty), or a ',' or ']'
+    expect = "["
+
+    while True:
+        pos = JSON_WHITESPACE.match(buf, pos).end()  # type: ignore[union-attr]
+        if pos >= len(buf):
+            if eof:
+                raise ValueError("Unexpected end of file while parsing JSON list")
+            chunk = fp.read(chunk_size)
+            eof = not chunk
+            buf, pos = chunk, 0
+            continue
+        char = buf[pos]
+        if expect == "[":
+            if char != "[":
+                raise ValueError(f"Expected a JSON list, found {char!r}")
+            pos += 1
+            expect = "value"
+        elif expect in ("value", "sep") and char == "]":
+            return
+        elif expect == "sep":
+            if char != ",":
+                raise ValueError(f"Expected ',' or ']' in JSON list, found {char!r}")
+            pos += 1
+            expect = "value"
+        else:
+            batch = None if loads is None else _decode_json_batch(loads, buf, pos)
+            if batch is not None:
+                objs, pos = batch
+                yield from objs
+                expect = "sep"
+                continue
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+                # a number at the end of the chunk may have been cut off
+                if end == len(buf) and not eof:
+                    raise json.JSONDecodeError("Value at end of chunk", buf, end)
+            except json.JSONDecodeError:
+                # the object is probably split across chunks, read more and try again
+                if eof:
+                    raise
+                chunk = fp.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            yield obj
+            pos = end
+            expect = "sep"
 
 
 def _read_json_file(path: PathIsh) -> Iterator[Dict[str, Any]]:
@@ -44,13 +156,24 @@ def _read_json_lines(fp: TextIO) -> Iterator[Dict[str, Any]]:
             yield orjson.loads(line)
 
     except ImportError:
-        import json
+        # json.loads checks the type and strips whitespace before calling
+        # raw_decode, which is noticeably slower for millions of short lines
+        raw_decode = json.JSONDecoder().raw_decode
 
         for line in fp:
-            yield json.loads(line)
+            try:
+                obj, end = raw_decode(line)
+            except json.JSONDecodeError:
+                # e.g. leading whitespace, let json.loads handle it or raise the error
+                obj, end = json.loads(line), len(line)
+            if end != len(line) and not line[end:].isspace():
+                raise json.JSONDecodeError("Extra data", line, end)
+            yield obj
 
 
 JSON_FORMATS = [".json", ".jsonl"]
+# formats this can map directly onto Visits, without detecting a browser
+KNOWN_FORMATS = JSON_FORMATS + [ARCHIVE_EXT]
 
 
 def _detect_extensions(path: PathIsh) -> str:
@@ -63,26 +186,97 @@ def _detect_extensions(path: PathIsh) -> str:
 
 
 def _parse_known_formats(path: PathIsh) -> Iterator[Visit]:
-    pth: Path = CPath(expand_path(path))  # type: ignore
     ext = _detect_extensions(path)
-    if ext not in JSON_FORMATS:
+    if ext not in KNOWN_FORMATS:
         raise ValueError(f"Unknown filetype: {path} extension={ext}")
+    if ext == ARCHIVE_EXT:
+        logger.debug("Reading as visit archive")
+        yield from read_archive(path)
+        return
+    pth: Path = CPath(expand_path(path))  # type: ignore
     if ext == ".json":
-        yield from map(Visit.from_dict, _read_json_file(pth))
+        yield from Visit.from_dicts(_read_json_file(pth))
     else:
         assert ext == ".jsonl", f"Unknown extension {ext}"
         logger.debug("Reading as JSON lines")
         with pth.open("r") as fp:
-            yield from map(Visit.from_dict, _read_json_lines(fp))
+            yield from Visit.from_dicts(_read_json_lines(fp))
 
 
-def _read_buf_as_sqlite_db(buf: BinaryIO) -> sqlite3.Connection:
-    """
-    Reads some binary file object as sqlite database
+SQLITE_MAGIC = b"SQLite format 3\x00"
 
-    Pass sys.stdin.buffer to read from stdin
+
+def _open_zstd(path: Path) -> BinaryIO:
+    try:
+        import zstandard  # type: ignore[import]
+    except ImportError:
+        raise BrowserexportError(
+            f"{path} is compressed with zstd, 'python3 -m pip install zstandard' to read it"
+        )
+    fp = path.open("rb")
+    return cast(BinaryIO, zstandard.ZstdDecompressor().stream_reader(fp, closefd=True))
+
+
+# magic bytes at the start of compressed files
+# https://en.wikipedia.org/wiki/List_of_file_signatures
+COMPRESSED_MAGIC: Dict[bytes, Callable[[Path], BinaryIO]] = {
+    b"\x1f\x8b": lambda p: cast(BinaryIO, gzip.open(p, "rb")),
+    b"\xfd7zXZ\x00": lambda p: cast(BinaryIO, lzma.open(p, "rb")),
+    b"BZh": lambda p: cast(BinaryIO, bz2.open(p, "rb")),
+    b"\x28\xb5\x2f\xfd": _open_zstd,
+}
+
+
+def _compressed_sqlite_opener(path: PathIsh) -> Optional[Callable[[Path], BinaryIO]]:
+    """
+    Check the magic bytes of the file to see if this is a compressed
+    file (e.g. a backup which was piped through gzip). If it is, returns
+    a function to open a decompressed stream of the file
+    """
+    try:
+        with expand_path(path).open("rb") as f:
+            header = f.read(len(SQLITE_MAGIC))
+    except OSError as e:
+        logger.debug(e, exc_info=True)
+        return None
+    if header == SQLITE_MAGIC:
+        return None
+    for magic, opener in COMPRESSED_MAGIC.items():
+        if header.startswith(magic):
+            return opener
+    return None
+
+
+def _log_ingest_throughput(nbytes: int, start: float) -> None:
+    elapsed = time.perf_counter() - start
+    rate = (nbytes / 1024**2) / elapsed if elapsed > 0 else float("inf")
+    logger.info(
+        f"Read {nbytes} bytes into in-memory sqlite database in {elapsed:.3f}s ({rate:.1f} MB/s)"
+    )
+
+
+def _deserialize_buf(buf: BinaryIO) -> sqlite3.Connection:
     """
+    Reads the buffer into memory once, and hands it directly to sqlite (python3.11+)
+    """
+    data: Union[bytes, bytearray] = buf.read()
+    # a deserialized database can't be opened in WAL mode, so if the
+    # file format version numbers say this is a WAL database, switch them
+    # back to the legacy (rollback journal) values. sqlite copies the data
+    # anyway, so only make a mutable copy when the header has to change
+    # https://www.sqlite.org/fileformat.html#file_format_version_numbers
+    if data[18:20] == b"\x02\x02":
+        data = bytearray(data)
+        data[18:20] = b"\x01\x01"
+    dbout = sqlite3.connect(":memory:")
+    dbout.deserialize(data)  # type: ignore[attr-defined]
+    return dbout
 
+
+def _backup_buf(buf: BinaryIO) -> sqlite3.Connection:
+    """
+    Writes the buffer to a tempfile, and then copies that into an in-memory database
+    """
     dbout = sqlite3.connect(":memory:")
 
     with tempfile.TemporaryDirectory() as td:
@@ -105,31 +299,219 @@ def _read_buf_as_sqlite_db(buf: BinaryIO) -> sqlite3.Connection:
     return dbout
 
 
+def _read_buf_as_sqlite_db(buf: BinaryIO) -> sqlite3.Connection:
+    """
+    Reads some binary file object as sqlite database
+
+    Pass sys.stdin.buffer to read from stdin
+    """
+    start = time.perf_counter()
+    dbout: sqlite3.Connection
+    if hasattr(sqlite3.Connection, "deserialize"):
+        dbout = _deserialize_buf(buf)
+    else:
+        dbout = _backup_buf(buf)
+    # the page count/size pragmas describe the database we just read
+    page_count = dbout.execute("PRAGMA page_count").fetchone()[0]
+    page_size = dbout.execute("PRAGMA page_size").fetchone()[0]
+    _log_ingest_throughput(page_count * page_size, start)
+    return dbout
+
+
+def _make_options(
+    since: Optional[datetime],
+    until: Optional[datetime],
+    url_like: Optional[str],
+    fields: Optional[Sequence[str]],
+    after_id: Optional[int] = None,
+) -> Optional[ExtractOptions]:
+    options = ExtractOptions(
+        since=since,
+        until=until,
+        url_like=url_like,
+        fields=None if fields is None else tuple(fields),
+        after_id=after_id,
+    )
+    return None if options == ExtractOptions() else options
+
+
 def read_visits(
-    path: PathIshOrConn, *, additional_browsers: Optional[List[Type[Browser]]] = None
+    path: PathIshOrConn,
+    *,
+    additional_browsers: Optional[List[Type[Browser]]] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    url_like: Optional[str] = None,
+    fields: Optional[Sequence[str]] = None,
+    after_id: Optional[int] = None,
+    read_options: Optional[ReadOptions] = None,
 ) -> Iterator[Visit]:
     """
     Takes one sqlite database as input and returns 'Visit's
+
+    since/until (timezone-aware datetimes) only return visits
+    where since <= visit < until, url_like is a SQL LIKE pattern
+    for the url. For databases, these are added to the query, so
+    the filtering is done by sqlite
+
+    fields are the Visit fields to extract, e.g. ('url', 'dt') skips
+    reading the metadata entirely
+
+    after_id only returns visits with a larger id in the
+    visit table, for browsers which support it (Schema.id_col)
+
+    read_options changes how the database is read (e.g. sqlite's mmap_size
+    and cache_size), if not passed these are read from the environment,
+    see sqlite.ReadOptions
     """
     browsers: List[Type[Browser]] = additional_browsers or []
     browsers += DEFAULT_BROWSERS
+    options = _make_options(since, until, url_like, fields, after_id)
     logger.info(f"Reading visits from {path}...")
+    yield from _read_source(
+        path, browsers, options, _extract_visits, iter, read_options
+    )
+
+
+def read_visits_batched(
+    path: PathIshOrConn,
+    *,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    additional_browsers: Optional[List[Type[Browser]]] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    url_like: Optional[str] = None,
+    fields: Optional[Sequence[str]] = None,
+    after_id: Optional[int] = None,
+    read_options: Optional[ReadOptions] = None,
+) -> Iterator[VisitBatch]:
+    """
+    Like read_visits, but returns VisitBatches of up to batch_size visits, which
+    store each field as a column, instead of creating a Visit for each row
+
+    Browsers which support it read the rows with fetchmany and convert the
+    timestamps for the whole batch at once (using numpy, if its installed)
+    """
+    browsers: List[Type[Browser]] = additional_browsers or []
+    browsers += DEFAULT_BROWSERS
+    options = _make_options(since, until, url_like, fields, after_id)
+    logger.info(f"Reading visit batches from {path}...")
+
+    def extract(
+        pth: PathIshOrConn,
+        brs: List[Type[Browser]],
+        opts: Optional[ExtractOptions],
+    ) -> Iterator[VisitBatch]:
+        br = detect_browser(pth, brs)
+        logger.debug(f"Detected as {br.__name__}")
+        return br.extract_batches(pth, batch_size, opts)
+
+    def known(visits: Iterator[Visit]) -> Iterator[VisitBatch]:
+        return batches_from_visits(visits, batch_size)
+
+    yield from _read_source(path, browsers, options, extract, known, read_options)
+
+
+T = TypeVar("T")
+
+
+def _read_source(
+    path: PathIshOrConn,
+    browsers: List[Type[Browser]],
+    options: Optional[ExtractOptions],
+    extract: Callable[
+        [PathIshOrConn, List[Type[Browser]], Optional[ExtractOptions]], Iterator[T]
+    ],
+    known: Callable[[Iterator[Visit]], Iterator[T]],
+    read_options: Optional[ReadOptions] = None,
+) -> Iterator[T]:
+    """
+    Handles merged files/compressed databases, else calls extract
+    to extract from the database. 'known' is used to convert visits from
+    a merged file to the right return type
+    """
+    if isinstance(path, (str, Path)) and _detect_extensions(path) in KNOWN_FORMATS:
+        logger.debug("Detected merged file, mapping to Visit directly")
+        if options is not None and options.after_id is not None:
+            raise BrowserexportError(f"Can't filter {path} by visit id")
+        read = 0
+
+        def parsed() -> Iterator[Visit]:
+            nonlocal read
+            for v in _parse_known_formats(path):
+                read += 1
+                yield v
 
-    if isinstance(path, (str, Path)) and _detect_extensions(path) in JSON_FORMATS:
-        logger.debug("Detected merged JSON file, mapping to Visit directly")
         try:
-            yield from _parse_known_formats(path)
+            if options is None:
+                yield from known(parsed())
+            else:
+                yield from known(
+                    options.project(v) for v in parsed() if options.matches(v)
+                )
             return
         except ValueError as e:
+            # the files are parsed lazily, so if some visits were already
+            # returned, the browsers can't be tried without duplicating them
+            if read > 0:
+                raise BrowserexportError(
+                    f"Failed to parse {path} after reading {read} visits: {e}"
+                ) from e
             logger.debug(e, exc_info=True)
             logger.warning(
                 f"Failed to parse {path} as known format, trying browsers instead"
             )
 
-    for br in browsers:
-        if br.detect(path):
-            logger.debug(f"Detected as {br.__name__}")
-            yield from br.extract_visits(path)
+    if isinstance(path, (str, Path)):
+        opener = _compressed_sqlite_opener(path)
+        if opener is not None:
+            logger.debug(f"Decompressing {path} into in-memory sqlite database")
+            with opener(expand_path(path)) as fp:
+                conn = _read_buf_as_sqlite_db(fp)
+            try:
+                yield from extract(conn, browsers, options)
+            finally:
+                conn.close()
             return
+        # use one connection to detect the browser and extract the visits,
+        # closed once the visits have been consumed (or this generator is closed)
+        conn = connect(path, read_options)
+        try:
+            yield from extract(conn, browsers, options)
+        finally:
+            conn.close()
+        return
+
+    yield from extract(path, browsers, options)
+
+
+def _extract_visits(
+    path: PathIshOrConn,
+    browsers: List[Type[Browser]],
+    options: Optional[ExtractOptions],
+) -> Iterator[Visit]:
+    br = detect_browser(path, browsers)
+    logger.debug(f"Detected as {br.__name__}")
+    if options is None:
+        # dont pass options, in case this is a custom browser which doesn't accept them
+        yield from br.extract_visits(path)
     else:
-        raise BrowserexportError(f"{path} didn't match any known schema")
+        yield from br.extract_visits(path, options)
+
+
+def detect_browser(path: PathIshOrConn, browsers: List[Type[Browser]]) -> Type[Browser]:
+    """
+    Reads the table names from the database once, and matches them against
+    each browser's detector. Browsers with a custom detector query, or
+    which override Browser.detect are checked by calling detect
+    """
+    tables = list_tables(path)
+    for br in browsers:
+        matched: Optional[bool] = None
+        if br.detect.__func__ is Browser.detect.__func__:  # type: ignore[attr-defined]
+            matched = br.detect_tables(tables)
+        if matched is None:
+            matched = br.detect(path)
+        if matched:
+            return br
+    raise BrowserexportError(f"{path} didn't match any known schema")
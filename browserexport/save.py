@@ -1,37 +1,237 @@
+import io
 import os
+import re
 import sys
+import time
+import threading
+import contextlib
+import glob
+import filecmp
+import gzip
+import lzma
+import hashlib
 import sqlite3
 import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, Type, Union
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    Union,
+    cast,
+)
 
 import click
 from sqlite_backup import sqlite_backup
+from sqlite_backup.core import atomic_copy
 
 from .log import logger
 from .common import PathIsh, expand_path, BrowserexportError
+from .common import state_dir, read_state_file, write_state_file
 from .browsers.all import DEFAULT_BROWSERS
 from .browsers.common import Browser
 
 
-def _progress(status: str, remaining: int, total: int) -> None:
-    logger.debug(f"Copied {total - remaining} of {total} database pages...")
+@dataclass(frozen=True)
+class Pace:
+    """
+    Limits how quickly a database is backed up, so a large database which is
+    in use (e.g. by the browser) isn't read from/written to all at once
+
+    Both copying the database files and copying pages into the backup are done in
+    steps of at most step_bytes, sleeping between steps so that on average no more
+    than bytes_per_sec are copied. If wal_checkpoint is False, the write-ahead log of
+    the backup isn't checkpointed into the backup after it's copied
+    """
+
+    bytes_per_sec: int
+    step_bytes: int = 4 * 1024**2
+    wal_checkpoint: bool = True
+
+    def __post_init__(self) -> None:
+        if self.bytes_per_sec < 1 or self.step_bytes < 1:
+            raise BrowserexportError("bytes_per_sec and step_bytes must be positive")
+
+    def step(self) -> int:
+        """
+        The number of bytes to copy in each step
+        """
+        return min(self.step_bytes, self.bytes_per_sec)
+
+    def wait(self, copied: int, elapsed: float) -> float:
+        """
+        Sleep for the rest of the time copying this many bytes should take
+        """
+        delay = copied / self.bytes_per_sec - elapsed
+        if delay > 0:
+            time.sleep(delay)
+            return delay
+        return 0.0
+
+
+class _Progress:
+    """
+    Passed as the progress callback for sqlite3's backup, which calls it after each
+    step. Logs how long each step took, and sleeps between steps if pace is set
+    """
+
+    def __init__(self, page_size: int, pace: Optional[Pace] = None) -> None:
+        self.page_size = page_size
+        self.pace = pace
+        self.done = 0
+        self.last = time.perf_counter()
+
+    def __call__(self, status: int, remaining: int, total: int) -> None:
+        now = time.perf_counter()
+        pages = total - remaining - self.done
+        self.done = total - remaining
+        elapsed = now - self.last
+        slept = 0.0
+        if self.pace is not None and remaining > 0:
+            slept = self.pace.wait(pages * self.page_size, elapsed)
+        logger.debug(
+            f"Copied {self.done} of {total} database pages ({pages} pages in {elapsed * 1000:.1f}ms, slept {slept * 1000:.1f}ms)..."
+        )
+        self.last = time.perf_counter()
+
+
+def _page_size(path: PathIsh) -> int:
+    # bytes 16-17 of the sqlite header, 1 means 65536 https://www.sqlite.org/fileformat.html
+    with open(path, "rb") as f:
+        size = int.from_bytes(f.read(100)[16:18], "big")
+    return 65536 if size == 1 else size or 4096
+
+
+# how many times _paced_copy copies a file which keeps changing, before
+# returning False and leaving it to sqlite_backup to retry/fail
+PACED_COPY_ATTEMPTS = 5
 
 
-def _sqlite_backup(src: PathIsh, dest: Optional[Path]) -> Optional[sqlite3.Connection]:
+def _stat_signature(path: str) -> Tuple[int, int]:
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def _paced_copy(pace: Pace) -> Callable[[str, str], bool]:
+    """
+    A replacement for sqlite_backup's atomic_copy which copies the database files
+    in steps, retrying if the file changed while it was being copied
+    """
+
+    def copy(src: str, dest: str) -> bool:
+        for attempt in range(1, PACED_COPY_ATTEMPTS + 1):
+            before = _stat_signature(src)
+            with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+                while True:
+                    start = time.perf_counter()
+                    chunk = fsrc.read(pace.step())
+                    if not chunk:
+                        break
+                    fdest.write(chunk)
+                    pace.wait(len(chunk), time.perf_counter() - start)
+            # like atomic_copy, only the permissions are copied, so dest has a different
+            # mtime and filecmp compares the contents
+            shutil.copymode(src, dest)
+            if _stat_signature(src) == before and filecmp.cmp(src, dest, shallow=True):
+                logger.debug(f"Copied '{src}' to '{dest}', unchanged: {attempt == 1}")
+                return attempt == 1
+            logger.debug(f"'{src}' changed while copying to '{dest}', retrying...")
+        logger.warning(
+            f"'{src}' changed each of the {PACED_COPY_ATTEMPTS} times it was copied"
+        )
+        return False
+
+    return copy
+
+
+def _sqlite_backup(
+    src: PathIsh, dest: Optional[Path], pace: Optional[Pace] = None
+) -> Optional[sqlite3.Connection]:
     logger.info(f"backing up {src} to {dest}")
+    page_size = _page_size(src)
+    progress = _Progress(page_size, pace)
+    backup_kwargs: Dict[str, Any] = {"progress": progress}
+    copy: Callable[[str, str], bool] = atomic_copy
+    if pace is not None:
+        backup_kwargs["pages"] = max(1, pace.step() // page_size)
+        copy = _paced_copy(pace)
+
+    def copy_function(src: str, dest: str) -> bool:
+        ok = copy(src, dest)
+        # the files are copied before the backup starts, so measure steps from here
+        progress.last = time.perf_counter()
+        return ok
+
     return sqlite_backup(
         src,
         dest,
-        wal_checkpoint=True,
+        wal_checkpoint=pace is None or pace.wal_checkpoint,
         copy_use_tempdir=True,
-        sqlite_backup_kwargs={"progress": _progress},
+        copy_function=copy_function,
+        sqlite_backup_kwargs=backup_kwargs,
     )
 
 
-def _print_sqlite_db_to_stdout(pth: Path) -> None:
+# formats which backups can be compressed with, and the suffix added to the filename
+COMPRESS_SUFFIXES = {"gz": ".gz", "xz": ".xz", "zst": ".zst"}
+
+COPY_BUFSIZE = 1024**2
+
+
+def _compressor(compress: str, fp: BinaryIO) -> BinaryIO:
+    """
+    Wrap a binary file, compressing anything written to it. Closing
+    the returned file flushes the compressor, but doesn't close fp
+
+    The output only depends on the input (gzip doesn't include the
+    current time), so backups of the same database are identical
+    """
+    if compress == "gz":
+        return cast(
+            BinaryIO,
+            gzip.GzipFile(filename="", mode="wb", fileobj=fp, compresslevel=6, mtime=0),
+        )
+    elif compress == "xz":
+        return cast(BinaryIO, lzma.LZMAFile(fp, "wb"))
+    elif compress == "zst":
+        try:
+            import zstandard  # type: ignore[import]
+        except ImportError:
+            raise BrowserexportError(
+                "'python3 -m pip install zstandard' to compress backups with zstd"
+            )
+        return cast(
+            BinaryIO, zstandard.ZstdCompressor().stream_writer(fp, closefd=False)
+        )
+    raise BrowserexportError(
+        f"Unknown compression format '{compress}', expected one of: {', '.join(COMPRESS_SUFFIXES)}"
+    )
+
+
+def _copy_to(pth: Path, out: BinaryIO, compress: Optional[str] = None) -> None:
+    """
+    Copy the backup at pth to out, compressing it as its read if compress is set
+    """
+    with open(pth, "rb") as f:
+        if compress is None:
+            shutil.copyfileobj(f, out, COPY_BUFSIZE)
+        else:
+            with _compressor(compress, out) as cf:
+                shutil.copyfileobj(f, cf, COPY_BUFSIZE)
+    out.flush()
+
+
+def _print_sqlite_db_to_stdout(pth: Path, compress: Optional[str] = None) -> None:
     force = "BROWSEREXPORT_FORCE" in os.environ
     # make sure the user is piping this to something else, otherwise dont print
     if click.get_text_stream("stdout").isatty() and not force:
@@ -41,9 +241,26 @@ def _print_sqlite_db_to_stdout(pth: Path) -> None:
         return
 
     logger.debug("writing bytes to stdout...")
-    with open(pth, "rb") as f:
-        shutil.copyfileobj(f, sys.stdout.buffer)  # type: ignore[misc]
-        sys.stdout.buffer.flush()
+    _copy_to(pth, sys.stdout.buffer, compress)  # type: ignore[misc]
+
+
+def _write_backup(
+    src: Path, dest: Path, compress: Optional[str] = None, pace: Optional[Pace] = None
+) -> None:
+    """
+    Backup src to dest. sqlite can only back up to a regular file, so if
+    compress is set, this backs up to a temporary file first, and then
+    compresses that into dest
+    """
+    if compress is None:
+        _sqlite_backup(src, dest, pace)
+        return
+    with tempfile.TemporaryDirectory() as td:
+        tfp = Path(td) / "backup.sqlite"
+        _sqlite_backup(src, tfp, pace)
+        logger.debug(f"compressing {tfp} to {dest} with {compress}")
+        with open(dest, "wb") as out:
+            _copy_to(tfp, out, compress)
 
 
 def _path_backup(
@@ -51,51 +268,230 @@ def _path_backup(
     dest: PathIsh,
     browser_name: Optional[str] = None,
     pattern: Optional[str] = None,
+    *,
+    skip_unchanged: bool = False,
+    state_path: Optional[PathIsh] = None,
+    compress: Optional[str] = None,
+    pace: Optional[Pace] = None,
 ) -> Optional[Path]:
     """
-    Backup from src to dest. If dest is '-', print to stdout
+    Backup from src to dest. If dest is '-', print to stdout. If compress
+    is set, the backup is compressed with that format (see COMPRESS_SUFFIXES).
+    If pace is set, limits how quickly the database is copied
 
-    Otherwise, return the path to the backup
+    Otherwise, return the path to the backup. If skip_unchanged is set
+    and the database hasn't changed since the last backup, returns the
+    path to the last backup instead, see _unchanged_backup
     """
     srcp: Path = expand_path(src)
     if str(dest) == "-":
+        if skip_unchanged:
+            raise BrowserexportError(
+                "Cannot skip unchanged databases while printing to stdout"
+            )
         # use temporary directory as its more windows-friendly
         with tempfile.TemporaryDirectory() as td:
             tfp = Path(tempfile.mktemp(suffix="-browser-stdin.sqlite", dir=td))
-            _sqlite_backup(srcp, tfp)
-            _print_sqlite_db_to_stdout(tfp)
+            _sqlite_backup(srcp, tfp, pace)
+            _print_sqlite_db_to_stdout(tfp, compress)
 
         assert not tfp.exists(), f"expected {tfp} to be deleted, but it still exists!"
         return None
     else:
         destp: Path = _default_pattern(
-            srcp, dest, browser_name=browser_name, pattern=pattern
+            srcp, dest, browser_name=browser_name, pattern=pattern, compress=compress
         )
-        _sqlite_backup(srcp, destp)
+        if skip_unchanged:
+            return _unchanged_backup(
+                srcp,
+                destp,
+                _backup_glob(
+                    srcp,
+                    dest,
+                    browser_name=browser_name,
+                    pattern=pattern,
+                    compress=compress,
+                ),
+                state_path,
+                compress,
+                pace,
+            )
+        _write_backup(srcp, destp, compress, pace)
         return destp
 
 
+def _pattern(
+    src: Path,
+    browser_name: Optional[str] = None,
+    pattern: Optional[str] = None,
+    compress: Optional[str] = None,
+) -> str:
+    suffix = src.suffix or ".sqlite"
+    if pattern is None:
+        pattern = (browser_name or "browser") + "-{}" + suffix
+    if compress is not None:
+        csuffix = COMPRESS_SUFFIXES.get(compress, "")
+        if not pattern.endswith(csuffix):
+            pattern += csuffix
+    return pattern
+
+
 def _default_pattern(
     src: Path,
     to: PathIsh,
     browser_name: Optional[str] = None,
     pattern: Optional[str] = None,
+    compress: Optional[str] = None,
 ) -> Path:
     """
     can pass a pattern with a format replacement field (for the timestamp)
     if you'd rather use a different format
 
     by default, this appends sqlite if that's not already the suffix,
-    adds the name of the browser and a timestamp
+    adds the name of the browser and a timestamp. If compress is set,
+    the suffix for that format is appended (e.g. firefox-{}.sqlite.gz)
     """
     to_p: Path = expand_path(to)
     assert to_p.is_dir(), f"{to_p} is not a directory!"
-    suffix = src.suffix or ".sqlite"
-    if pattern is None:
-        pattern = (browser_name or "browser") + "-{}" + suffix
     # create pattern to timestamp backup filename
     now: str = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-    return to_p / pattern.format(now)
+    return to_p / _pattern(src, browser_name, pattern, compress).format(now)
+
+
+def _backup_glob(
+    src: Path,
+    to: PathIsh,
+    browser_name: Optional[str] = None,
+    pattern: Optional[str] = None,
+    compress: Optional[str] = None,
+) -> str:
+    """
+    A glob which matches the previous backups created with the same pattern
+    """
+    parts = _pattern(src, browser_name, pattern, compress).split("{}")
+    return str(
+        Path(glob.escape(str(expand_path(to))))
+        / "*".join(glob.escape(p) for p in parts)
+    )
+
+
+STATE_VERSION = 1
+
+# bytes 24-27 of the sqlite header, incremented whenever the database file
+# is modified (outside of the write-ahead log) https://www.sqlite.org/fileformat.html
+CHANGE_COUNTER = slice(24, 28)
+
+
+_STATE_LOCK = threading.Lock()
+
+
+def default_state_path() -> Path:
+    return state_dir() / "save.json"
+
+
+def _fingerprint(src: Path) -> Dict[str, Any]:
+    """
+    The size/modification time of the database and its write-ahead log, and
+    the change counter from the database header. If any of these differ,
+    the database may have changed
+    """
+    fp: Dict[str, Any] = {}
+    for name, path in (("db", src), ("wal", src.with_name(src.name + "-wal"))):
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            fp[name] = None
+            continue
+        fp[name] = [st.st_size, st.st_mtime_ns]
+    with open(src, "rb") as f:
+        fp["change_counter"] = int.from_bytes(f.read(100)[CHANGE_COUNTER], "big")
+    return fp
+
+
+def _hash_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024**2), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _same_contents(a: Path, b: Path) -> bool:
+    if a.stat().st_size != b.stat().st_size:
+        return False
+    return _hash_file(a) == _hash_file(b)
+
+
+def _newest_backup(backups: List[str]) -> Optional[Path]:
+    paths = [Path(p) for p in backups if os.path.isfile(p)]
+    if not paths:
+        return None
+    return max(paths, key=lambda p: p.stat().st_mtime_ns)
+
+
+def _unchanged_backup(
+    src: Path,
+    dest: Path,
+    backup_glob: str,
+    state_path: Optional[PathIsh],
+    compress: Optional[str] = None,
+    pace: Optional[Pace] = None,
+) -> Path:
+    """
+    Backup src to dest, unless the database hasn't changed since the last backup
+
+    First, compares the fingerprint of the database against the one saved in the
+    state file after the last backup. If that differs (e.g. the browser was opened,
+    but no pages were visited), backs up the database and compares it to the newest
+    backup matching backup_glob, removing the new backup if they're identical
+
+    Returns the path to the new backup, or the previous one if nothing changed
+    """
+    state_file = expand_path(state_path) if state_path else default_state_path()
+    data = read_state_file(state_file, STATE_VERSION)
+    databases: Dict[str, Any] = data.get("databases", {})
+    key = str(src)
+    fingerprint = _fingerprint(src)
+
+    last = databases.get(key)
+    if (
+        last is not None
+        and last.get("fingerprint") == fingerprint
+        and os.path.isfile(last.get("backup", ""))
+    ):
+        logger.info(f"{src} hasn't changed since the backup at {last['backup']}")
+        return Path(last["backup"])
+
+    previous = _newest_backup(glob.glob(backup_glob))
+    # back up to a temporary file first, since the filename may be
+    # the same as the previous backup, if it was in the same second
+    tmp = dest.with_name(f".{dest.name}.tmp")
+    _write_backup(src, tmp, compress, pace)
+    if previous is not None and _same_contents(tmp, previous):
+        logger.info(f"{src} is identical to the backup at {previous}, removing {tmp}")
+        tmp.unlink()
+        dest = previous
+    else:
+        os.replace(tmp, dest)
+
+    # other databases may have been backed up (in other threads) since this read the state
+    with _STATE_LOCK:
+        databases = read_state_file(state_file, STATE_VERSION).get("databases", {})
+        databases[key] = {"fingerprint": fingerprint, "backup": str(dest)}
+        write_state_file(state_file, STATE_VERSION, {"databases": databases})
+    return dest
+
+
+def _pick_browser(browser: Union[str, Type[Browser]]) -> Tuple[Type[Browser], str]:
+    """
+    Returns the browser and its (lowercased) name, given a name or a Browser
+    """
+    if isinstance(browser, str):
+        for extr in DEFAULT_BROWSERS:
+            if browser.lower() == extr.__name__.lower():
+                return extr, browser.lower()
+        raise BrowserexportError(f"Unknown browser: {browser}")
+    return browser, browser.__name__.lower()
 
 
 def backup_history(
@@ -104,6 +500,10 @@ def backup_history(
     *,
     profile: str = "*",
     pattern: Optional[str] = None,
+    skip_unchanged: bool = False,
+    state_path: Optional[PathIsh] = None,
+    compress: Optional[str] = None,
+    pace: Optional[Pace] = None,
 ) -> Optional[Path]:
     """
     browser:
@@ -117,30 +517,159 @@ def backup_history(
         a glob to select a particular profile
     pattern:
         pattern for the resulting timestamped filename, should include an str.format replacement placeholder
+    skip_unchanged:
+        if the database hasn't changed since the last backup, don't create a new one
+    state_path:
+        file to save the state of each database to, used with skip_unchanged
+        defaults to $XDG_STATE_HOME/browserexport/save.json
+    compress:
+        compress the backup with one of 'gz', 'xz' or 'zst' (requires zstandard)
+    pace:
+        limit how quickly the database is copied, see Pace
 
     returns:
         path to the backup, or None if printing to stdout
+        if skip_unchanged is set and nothing changed, the path to the previous backup
     """
 
-    chosen: Type[Browser]
-    browser_name: str
-    if isinstance(browser, str):
-        for extr in DEFAULT_BROWSERS:
-            if browser.lower() == extr.__name__.lower():
-                chosen = extr
-                browser_name = browser.lower()
-                break
-        else:
-            raise BrowserexportError(f"Unknown browser: {browser}")
-    else:
-        chosen = browser
-        browser_name = chosen.__name__.lower()
+    chosen, browser_name = _pick_browser(browser)
     src: Path = chosen.locate_database(profile)
     dest: Optional[Path] = _path_backup(
-        src, to, browser_name=browser_name, pattern=pattern
+        src,
+        to,
+        browser_name=browser_name,
+        pattern=pattern,
+        skip_unchanged=skip_unchanged,
+        state_path=state_path,
+        compress=compress,
+        pace=pace,
     )
     if str(to) == "-":
         assert (
             dest is None
         ), f"expected dest to be None since we printed to stdout, got {dest}"
     return dest
+
+
+@dataclass
+class BackupResult:
+    """
+    The result of backing up one database with backup_all. If the backup
+    failed, dest is None and error is the reason
+    """
+
+    browser: str
+    profile: str
+    src: Path
+    dest: Optional[Path] = None
+    size: int = 0
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+
+def _profile_name(src: Path, bases: Sequence[Path]) -> str:
+    # the directory the database is in, unless its directly in the data directory
+    if src.parent in bases:
+        return ""
+    return re.sub(r"[^\w.-]+", "_", src.parent.name).strip("_")
+
+
+def locate_all(
+    browsers: Optional[Sequence[Union[str, Type[Browser]]]] = None,
+    profile: str = "*",
+) -> List[Tuple[Type[Browser], str, Path]]:
+    """
+    Locate every database matching profile, for each browser (defaults to all of the
+    browsers which can be saved). Browsers which aren't installed are skipped
+
+    Returns the browser, a name for the profile (unique for each browser,
+    and safe to use in a filename), and the path to the database
+    """
+    chosen = (
+        [_pick_browser(b)[0] for b in browsers]
+        if browsers is not None
+        else [b for b in DEFAULT_BROWSERS if b.has_save]
+    )
+    found: List[Tuple[Type[Browser], str, Path]] = []
+    seen = set()
+    for browser in chosen:
+        # handle_path warns about browsers which aren't supported on this
+        # platform, which is expected when checking every browser
+        warnings = io.StringIO()
+        try:
+            with contextlib.redirect_stderr(warnings):
+                dbs = browser.locate_databases(profile)
+                bases = list(browser.data_directories())
+        except (BrowserexportError, NotImplementedError) as e:
+            logger.debug(f"Skipping {browser.__name__}: {e}", exc_info=True)
+            continue
+        finally:
+            if warnings.getvalue():
+                logger.debug(warnings.getvalue().strip())
+        names: Dict[str, int] = {}
+        for db in sorted(dbs):
+            if db.resolve() in seen:
+                continue
+            seen.add(db.resolve())
+            name = _profile_name(db, bases)
+            # profiles with the same directory name in different data directories
+            names[name] = names.get(name, 0) + 1
+            if names[name] > 1:
+                name = f"{name}-{names[name]}"
+            found.append((browser, name, db))
+    return found
+
+
+def backup_all(
+    to: PathIsh,
+    *,
+    browsers: Optional[Sequence[Union[str, Type[Browser]]]] = None,
+    profile: str = "*",
+    jobs: int = 4,
+    skip_unchanged: bool = False,
+    state_path: Optional[PathIsh] = None,
+    compress: Optional[str] = None,
+    pace: Optional[Pace] = None,
+) -> List[BackupResult]:
+    """
+    Back up every database found by locate_all to the 'to' directory, using
+    up to 'jobs' threads. Each backup is named after the browser and
+    profile, e.g. firefox-abcd1234.default-release-{}.sqlite
+
+    If a backup fails, the error is saved in its result, and the
+    rest of the databases are still backed up
+    """
+    if str(to) == "-":
+        raise BrowserexportError("Cannot print multiple databases to stdout")
+    found = locate_all(browsers, profile)
+    if not found:
+        raise BrowserexportError("Could not find any databases to back up")
+
+    def _backup(browser: Type[Browser], name: str, src: Path) -> BackupResult:
+        browser_name = browser.__name__.lower()
+        res = BackupResult(browser=browser_name, profile=name, src=src)
+        suffix = src.suffix or ".sqlite"
+        pattern = "-".join(filter(None, (browser_name, name, "{}"))) + suffix
+        start = time.perf_counter()
+        try:
+            res.dest = _path_backup(
+                src,
+                to,
+                pattern=pattern,
+                skip_unchanged=skip_unchanged,
+                state_path=state_path,
+                compress=compress,
+                pace=pace,
+            )
+            assert res.dest is not None
+            res.size = res.dest.stat().st_size
+        except Exception as e:
+            logger.warning(f"Failed to back up {src}: {e}")
+            logger.debug(e, exc_info=True)
+            res.error = str(e) or type(e).__name__
+        res.seconds = time.perf_counter() - start
+        return res
+
+    # sqlite3 releases the GIL while copying pages, so backups run concurrently
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        return list(pool.map(lambda f: _backup(*f), found))
@@ -1,29 +1,271 @@
+import os
 import sqlite3
 
-from typing import Iterator
+from dataclasses import dataclass
+from collections import OrderedDict
+from itertools import chain, islice
+from typing import Iterator, FrozenSet, Sequence, Any, List, Dict, Tuple, Optional
 
-from .common import expand_path, PathIshOrConn
+from .common import expand_path, PathIsh, PathIshOrConn, BrowserexportError
+from .log import logger
 
+Tables = FrozenSet[str]
 
-def _execute_conn(conn: sqlite3.Connection, query: str) -> Iterator[sqlite3.Row]:
+
+Params = Sequence[Any]
+
+TEMP_STORE = ("default", "file", "memory")
+
+
+@dataclass(frozen=True)
+class ReadOptions:
     """
-    Given an open sqlite3 connection, execute a query
+    How databases are opened and read. If not passed, the defaults can be
+    changed with BROWSEREXPORT_SQLITE_* environment variables, see from_env
+
+    mmap_size/cache_size are in bytes, arraysize is how many rows are fetched
+    from sqlite at a time. If fast_decode is set, text is decoded by sqlite3
+    directly, falling back to ignoring invalid UTF-8 if a value fails to decode
+    """
+
+    mmap_size: int = 256 * 1024**2
+    cache_size: int = 64 * 1024**2
+    temp_store: str = "memory"
+    arraysize: int = 1000
+    fast_decode: bool = True
+
+    def __post_init__(self) -> None:
+        if self.temp_store not in TEMP_STORE:
+            raise BrowserexportError(
+                f"Unknown temp_store '{self.temp_store}', expected one of: {', '.join(TEMP_STORE)}"
+            )
+        if self.arraysize < 1:
+            raise BrowserexportError("arraysize must be at least 1")
+
+    def pragmas(self) -> List[str]:
+        return [
+            f"PRAGMA mmap_size={int(self.mmap_size)}",
+            # negative values are KiB, instead of pages
+            f"PRAGMA cache_size={-(int(self.cache_size) // 1024)}",
+            f"PRAGMA temp_store={self.temp_store}",
+        ]
+
+    @classmethod
+    def from_env(cls) -> "ReadOptions":
+        """
+        Read options from BROWSEREXPORT_SQLITE_MMAP_SIZE, BROWSEREXPORT_SQLITE_CACHE_SIZE,
+        BROWSEREXPORT_SQLITE_TEMP_STORE, BROWSEREXPORT_SQLITE_ARRAYSIZE and
+        BROWSEREXPORT_SQLITE_FAST_DECODE, using the defaults for any that aren't set
+        """
+        kwargs: Dict[str, Any] = {}
+        for name, typ in (
+            ("mmap_size", int),
+            ("cache_size", int),
+            ("temp_store", str),
+            ("arraysize", int),
+            ("fast_decode", bool),
+        ):
+            env = f"BROWSEREXPORT_SQLITE_{name.upper()}"
+            val = os.environ.get(env)
+            if val is None:
+                continue
+            if typ is bool:
+                kwargs[name] = val.strip().lower() not in ("0", "false", "no", "")
+            elif typ is int:
+                try:
+                    kwargs[name] = int(val)
+                except ValueError:
+                    raise BrowserexportError(f"{env} must be an integer, got {val!r}")
+            else:
+                kwargs[name] = val.strip().lower()
+        return cls(**kwargs)
+
+
+class _Connection(sqlite3.Connection):
+    read_options: ReadOptions
+    # the file, if it was opened as immutable, so list_tables can use its cache
+    immutable_path: Optional[str] = None
+
+
+def _read_options(conn: sqlite3.Connection) -> ReadOptions:
+    # connections which weren't opened with connect (e.g. an in-memory database)
+    opts = getattr(conn, "read_options", None)
+    return opts if opts is not None else ReadOptions.from_env()
+
+
+def connect(
+    path: PathIsh, read_options: Optional[ReadOptions] = None, *, live: bool = False
+) -> _Connection:
+    """
+    Open a database read-only (as immutable), with the pragmas from read_options
+
+    If live is True, the database may be in use (e.g. the browser's current
+    history), so its opened normally in read-only mode instead, which reads
+    any changes still in the write-ahead log
+    """
+    p: str = str(expand_path(path))
+    opts = read_options if read_options is not None else ReadOptions.from_env()
+    uri = f"file:{p}?mode=ro" if live else f"file:{p}?immutable=1"
+    conn = sqlite3.connect(uri, uri=True, factory=_Connection)
+    conn.read_options = opts
+    if not live:
+        conn.immutable_path = p
+    for pragma in opts.pragmas():
+        conn.execute(pragma)
+    return conn
+
+
+def _decode_lossy(b: bytes) -> str:
+    return b.decode(errors="ignore")
+
+
+def _fetch(
+    conn: sqlite3.Connection, query: str, params: Params, batch_size: int
+) -> Iterator[List[sqlite3.Row]]:
+    cur = conn.execute(query, params)
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+
+def _execute_conn_batched(
+    conn: sqlite3.Connection,
+    query: str,
+    params: Params = (),
+    batch_size: Optional[int] = None,
+) -> Iterator[List[sqlite3.Row]]:
+    """
+    Given an open sqlite3 connection, execute a query, yielding lists of rows
     """
+    opts = _read_options(conn)
+    size = batch_size or opts.arraysize
     conn.row_factory = sqlite3.Row
-    conn.text_factory = lambda b: b.decode(errors="ignore")
-    for row in conn.execute(query):
-        yield row
+    if not opts.fast_decode:
+        conn.text_factory = _decode_lossy
+        yield from _fetch(conn, query, params, size)
+        return
+    # str is decoded in C by sqlite3, which is much faster than calling a function
+    # for every value, but raises an error if any text is invalid UTF-8
+    conn.text_factory = str
+    done = 0
+    try:
+        for rows in _fetch(conn, query, params, size):
+            yield rows
+            done += len(rows)
+    except sqlite3.OperationalError as e:
+        if "decode" not in str(e):
+            raise
+        logger.debug(f"{e}, decoding text while ignoring invalid UTF-8 instead")
+        # run the query again, skipping the rows which were already returned
+        conn.text_factory = _decode_lossy
+        rest = islice(
+            chain.from_iterable(_fetch(conn, query, params, size)), done, None
+        )
+        while True:
+            rows = list(islice(rest, size))
+            if not rows:
+                return
+            yield rows
+
+
+def _execute_conn(
+    conn: sqlite3.Connection, query: str, params: Params = ()
+) -> Iterator[sqlite3.Row]:
+    """
+    Given an open sqlite3 connection, execute a query
+    """
+    for rows in _execute_conn_batched(conn, query, params):
+        yield from rows
 
 
-def execute_query(path: PathIshOrConn, query: str) -> Iterator[sqlite3.Row]:
+def execute_query(
+    path: PathIshOrConn, query: str, params: Params = ()
+) -> Iterator[sqlite3.Row]:
     """
     Given a str, path, or sqlite3 connection, execute a query
     """
     if isinstance(path, sqlite3.Connection):
-        # WARNING: if this happens but you're yielding lazily from a function
-        # the connection might close before this query finishes executing
-        yield from _execute_conn(path, query)
+        # the caller owns the connection, it has to stay open
+        # until the rows have been consumed
+        yield from _execute_conn(path, query, params)
+    else:
+        # closed once all the rows are consumed, or this generator is closed
+        conn = connect(path)
+        try:
+            yield from _execute_conn(conn, query, params)
+        finally:
+            conn.close()
+
+
+def execute_query_batched(
+    path: PathIshOrConn, query: str, params: Params = (), *, batch_size: int
+) -> Iterator[List[sqlite3.Row]]:
+    """
+    Like execute_query, but yields lists of up to batch_size rows, using fetchmany
+    """
+    if isinstance(path, sqlite3.Connection):
+        yield from _execute_conn_batched(path, query, params, batch_size)
     else:
-        p: str = str(expand_path(path))
-        with sqlite3.connect(f"file:{p}?immutable=1", uri=True) as c:
-            yield from _execute_conn(c, query)
+        conn = connect(path)
+        try:
+            yield from _execute_conn_batched(conn, query, params, batch_size)
+        finally:
+            conn.close()
+
+
+def columns(rows: Sequence[sqlite3.Row]) -> Dict[str, Tuple[Any, ...]]:
+    """
+    Transpose a batch of rows into a column for each name
+    """
+    cols: Dict[str, Tuple[Any, ...]] = {}
+    if not rows:
+        return cols
+    for name, col in zip(rows[0].keys(), zip(*rows)):
+        # like row[name], if there are duplicate names use the first one
+        cols.setdefault(name, col)
+    return cols
+
+
+TABLES_QUERY = "SELECT name FROM sqlite_master WHERE type IN ('table', 'view')"
+
+
+def _query_tables(path: PathIshOrConn) -> Tables:
+    # sqlite table names are case-insensitive
+    return frozenset(row["name"].lower() for row in execute_query(path, TABLES_QUERY))
+
+
+TABLES_CACHE_SIZE = 1024
+
+# the key includes the size and modification time of the file, so
+# if a database is modified in place the cached entry is not used
+_tables_cache: "OrderedDict[Tuple[str, int, int], Tables]" = OrderedDict()
+
+
+def _cached_tables(path: str, conn: Optional[sqlite3.Connection] = None) -> Tables:
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    tables = _tables_cache.get(key)
+    if tables is not None:
+        _tables_cache.move_to_end(key)
+        return tables
+    # if the caller already has the database open, use that connection
+    tables = _tables_cache[key] = _query_tables(conn if conn is not None else path)
+    if len(_tables_cache) > TABLES_CACHE_SIZE:
+        _tables_cache.popitem(last=False)
+    return tables
+
+
+def list_tables(path: PathIshOrConn) -> Tables:
+    """
+    Return the (lowercased) names of all tables/views in the database, by reading
+    sqlite_master. For paths (and connections opened as immutable by connect),
+    this is cached by (path, size, mtime)
+    """
+    if isinstance(path, sqlite3.Connection):
+        immutable_path = getattr(path, "immutable_path", None)
+        if immutable_path is None:
+            return _query_tables(path)
+        return _cached_tables(immutable_path, path)
+    return _cached_tables(str(expand_path(path)))
@@ -0,0 +1,240 @@
+"""
+Write merged visits to a file, picking the format from the extension
+"""
+
+import os
+import sqlite3
+from itertools import islice
+from datetime import datetime, timezone
+from typing import Any, BinaryIO, Iterable, Dict, List, Tuple, Optional, Callable
+
+from .common import PathIsh, expand_path, BrowserexportError
+from .model import Visit
+from .archive import ARCHIVE_EXT, write_archive
+from .log import logger
+
+SQLITE_ARCHIVE_VERSION = 1
+
+# visit_time is microseconds since the epoch, urls are stored unquoted
+SQLITE_ARCHIVE_SCHEMA = """
+CREATE TABLE browserexport_archive (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE urls (id INTEGER PRIMARY KEY, url TEXT NOT NULL UNIQUE);
+CREATE TABLE visits (
+    id INTEGER PRIMARY KEY,
+    url_id INTEGER NOT NULL REFERENCES urls (id),
+    visit_time INTEGER NOT NULL,
+    title TEXT,
+    description TEXT,
+    preview_image TEXT,
+    duration INTEGER
+);
+"""
+
+# created after the visits are inserted, which is faster than updating them on every insert
+SQLITE_ARCHIVE_INDEXES = """
+CREATE INDEX visits_visit_time ON visits (visit_time);
+CREATE INDEX visits_url_id ON visits (url_id);
+"""
+
+VisitRow = Tuple[int, int, Optional[str], Optional[str], Optional[str], Optional[int]]
+
+
+def write_sqlite_archive(
+    visits: Iterable[Visit], path: PathIsh, *, batch_size: int = 50_000
+) -> int:
+    """
+    Write visits to a new sqlite database, which can be read back
+    with the BrowserexportArchive browser. Returns the number of visits written
+
+    Rows are inserted in batches with executemany, in a single transaction
+    """
+    target = expand_path(path)
+    if target.exists():
+        raise BrowserexportError(f"{target} already exists, not overwriting")
+    # write to a temporary file and rename it once it's complete,
+    # so a failed merge doesn't leave a partial archive behind
+    tmp = target.with_name(target.name + ".tmp")
+    count = 0
+    url_ids: Dict[str, int] = {}
+    new_urls: List[Tuple[int, str]] = []
+    rows: List[VisitRow] = []
+
+    conn = sqlite3.connect(str(tmp))
+    try:
+        # this is a new file, if this fails we remove it anyways
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.executescript(SQLITE_ARCHIVE_SCHEMA)
+
+        def flush() -> None:
+            conn.executemany("INSERT INTO urls VALUES (?, ?)", new_urls)
+            conn.executemany(
+                "INSERT INTO visits (url_id, visit_time, title, description, preview_image, duration) VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            new_urls.clear()
+            rows.clear()
+
+        with conn:
+            for v in visits:
+                url_id = url_ids.get(v.url)
+                if url_id is None:
+                    url_id = url_ids[v.url] = len(url_ids) + 1
+                    new_urls.append((url_id, v.url))
+                md = v.metadata
+                if md is None:
+                    rows.append((url_id, v.ts, None, None, None, None))
+                else:
+                    rows.append(
+                        (
+                            url_id,
+                            v.ts,
+                            md.title,
+                            md.description,
+                            md.preview_image,
+                            md.duration,
+                        )
+                    )
+                count += 1
+                if len(rows) >= batch_size:
+                    flush()
+            flush()
+            conn.executemany(
+                "INSERT INTO browserexport_archive VALUES (?, ?)",
+                [
+                    ("version", str(SQLITE_ARCHIVE_VERSION)),
+                    ("created", datetime.now(tz=timezone.utc).isoformat()),
+                ],
+            )
+        logger.debug("Creating indexes...")
+        conn.executescript(SQLITE_ARCHIVE_INDEXES)
+    except BaseException:
+        conn.close()
+        tmp.unlink()
+        raise
+    conn.close()
+    os.replace(tmp, target)
+    logger.info(f"Wrote {count} visits ({len(url_ids)} urls) to {target}")
+    return count
+
+
+def _serialize(v: Visit) -> Dict[str, Any]:
+    # same as v.serialize(), without creating an intermediate dict with Metadata._asdict
+    md = v.metadata
+    return {
+        "url": v.url,
+        "dt": v.ts / 1_000_000,
+        "metadata": (
+            None
+            if md is None
+            else {
+                "title": md.title,
+                "description": md.description,
+                "preview_image": md.preview_image,
+                "duration": md.duration,
+            }
+        ),
+    }
+
+
+Dumps = Callable[[Any], bytes]
+
+
+def _json_dumps() -> Tuple[Dumps, Dumps]:
+    """
+    Returns functions to encode an object and an object followed by a newline,
+    using orjson if its installed
+    """
+    try:
+        import orjson  # type: ignore[import]
+
+        def dumps_line(obj: Any) -> bytes:
+            return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)  # type: ignore[no-any-return]
+
+        return orjson.dumps, dumps_line
+    except ModuleNotFoundError:
+        import json
+
+        # json.dumps creates a new encoder on every call if any options are passed
+        encode = json.JSONEncoder(separators=(",", ":")).encode
+
+        def dumps(obj: Any) -> bytes:
+            return encode(obj).encode("utf-8")
+
+        def dumps_line(obj: Any) -> bytes:
+            return (encode(obj) + "\n").encode("utf-8")
+
+        return dumps, dumps_line
+
+
+def write_json(
+    visits: Iterable[Visit],
+    fp: BinaryIO,
+    *,
+    lines: bool = False,
+    batch_size: int = 10_000,
+) -> int:
+    """
+    Write visits to a binary file object as a JSON list, or as one
+    JSON object per line if lines is True. Returns the number of visits written
+
+    Visits are encoded and written batch_size at a time, so this
+    uses constant memory even when writing a list
+    """
+    dumps, dumps_line = _json_dumps()
+    count = 0
+    it = iter(visits)
+    if not lines:
+        fp.write(b"[")
+    while True:
+        chunk = [_serialize(v) for v in islice(it, batch_size)]
+        if not chunk:
+            break
+        if lines:
+            fp.write(b"".join(map(dumps_line, chunk)))
+        else:
+            # encode the whole batch as a list, and strip the brackets
+            if count > 0:
+                fp.write(b",")
+            fp.write(dumps(chunk)[1:-1])
+        count += len(chunk)
+    if not lines:
+        fp.write(b"]\n")
+    return count
+
+
+def write_json_file(visits: Iterable[Visit], path: PathIsh) -> int:
+    """
+    Write visits to a .json (a list) or .jsonl (one visit per line) file
+    """
+    target = expand_path(path)
+    with target.open("wb") as f:
+        count = write_json(visits, f, lines=target.suffix == ".jsonl")
+    logger.info(f"Wrote {count} visits to {target}")
+    return count
+
+
+SQLITE_EXTENSIONS = [".sqlite", ".db"]
+JSON_EXTENSIONS = [".json", ".jsonl"]
+
+Writer = Callable[[Iterable[Visit], PathIsh], int]
+
+WRITERS: Dict[str, Writer] = {
+    ARCHIVE_EXT: write_archive,
+    **{ext: write_sqlite_archive for ext in SQLITE_EXTENSIONS},
+    **{ext: write_json_file for ext in JSON_EXTENSIONS},
+}
+
+
+def write_visits(visits: Iterable[Visit], path: PathIsh) -> int:
+    """
+    Write visits to path, using the file extension to pick the format.
+    Returns the number of visits written
+    """
+    _, ext = os.path.splitext(str(path))
+    writer = WRITERS.get(ext)
+    if writer is None:
+        raise BrowserexportError(
+            f"Unsupported output format '{ext}', expected one of: {', '.join(WRITERS)}"
+        )
+    return writer(visits, path)
@@ -1,13 +1,23 @@
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 from pathlib import Path
-from typing import Iterator, Sequence
+from typing import Any, Iterator, List, Sequence
 import sqlite3
+import sys
 
 import pytest
 
-from browserexport.common import expand_path
-from browserexport.parse import read_visits
-from browserexport.merge import read_and_merge
+from browserexport.common import expand_path, BrowserexportError
+from browserexport.parse import (
+    read_visits,
+    detect_browser,
+    read_visits_batched,
+    _read_buf_as_sqlite_db,
+    _deserialize_buf,
+    _backup_buf,
+)
+from browserexport.merge import read_and_merge, merge_visits
+from browserexport.browsers.common import ExtractOptions
+from browserexport.browsers.all import DEFAULT_BROWSERS
 
 
 def test_using_conn(firefox: Path) -> None:
@@ -19,6 +29,25 @@ def test_using_conn(firefox: Path) -> None:
     assert len(visits) == 4
 
 
+@pytest.mark.skipif(
+    not hasattr(sqlite3.Connection, "deserialize"), reason="requires python3.11+"
+)
+def test_deserialize_buf(firefox: Path, chrome: Path) -> None:
+    for db, count in ((firefox, 4), (chrome, 6)):
+        with open(db, "rb") as f:
+            conn = _deserialize_buf(f)
+        assert len(list(read_visits(conn))) == count
+
+
+def test_read_buf_as_sqlite_db(firefox: Path) -> None:
+    with open(firefox, "rb") as f:
+        conn = _backup_buf(f)
+    assert len(list(read_visits(conn))) == 4
+    with open(firefox, "rb") as f:
+        conn = _read_buf_as_sqlite_db(f)
+    assert len(list(read_visits(conn))) == 4
+
+
 def test_read_visits(firefox: Path) -> None:
     vis = list(read_visits(firefox))
     assert len(vis) == 4
@@ -40,6 +69,46 @@ def test_serialize_visit(firefox: Path) -> None:
     assert sr_v["url"] == "https://www.mozilla.org/privacy/firefox/"
 
 
+@pytest.mark.parametrize(
+    "name,expected",
+    [
+        ("firefox", "Firefox"),
+        ("waterfox", "Firefox"),
+        ("palemoon", "Palemoon"),
+        ("chrome", "Chrome"),
+        ("safari", "Safari"),
+        ("firefox_mobile", "FirefoxMobile"),
+        ("firefox_mobile_legacy", "FirefoxMobileLegacy"),
+    ],
+)
+def test_detect_browser(name: str, expected: str) -> None:
+    db = _database(name)
+    assert detect_browser(db, DEFAULT_BROWSERS).__name__ == expected
+    # should also work with a connection
+    conn = sqlite3.connect(f"file:{str(db)}?immutable=1", uri=True)
+    try:
+        assert detect_browser(conn, DEFAULT_BROWSERS).__name__ == expected
+    finally:
+        conn.close()
+
+
+def test_detect_browser_override(chrome: Path) -> None:
+    from browserexport.browsers.common import PathIshOrConn
+    from browserexport.browsers.chrome import Chrome
+
+    called: List[PathIshOrConn] = []
+
+    class NotChrome(Chrome):
+        @classmethod
+        def detect(cls, path: PathIshOrConn) -> bool:
+            called.append(path)
+            return False
+
+    # detect is called, even though the detector is a table name
+    assert detect_browser(chrome, [NotChrome, *DEFAULT_BROWSERS]) is Chrome
+    assert called == [chrome]
+
+
 def test_merge_db(firefox: Path) -> None:
     # two of the same, should remove duplicates
     # and be the same as read_visits
@@ -49,6 +118,48 @@ def test_merge_db(firefox: Path) -> None:
     assert unique_count == direct_read_count
 
 
+def test_merge_parallel(chrome: Path, firefox: Path, waterfox: Path) -> None:
+    dbs: Sequence[Path] = [chrome, firefox, waterfox, firefox]
+    serial = list(read_and_merge(dbs))
+    assert list(read_and_merge(dbs, workers=2)) == serial
+
+
+def test_merge_max_memory(chrome: Path, firefox: Path, json_dump: Path) -> None:
+    dbs: Sequence[Path] = [chrome, firefox, json_dump, firefox, chrome]
+    # small enough that the keys have to be written to disk
+    assert list(read_and_merge(dbs, max_memory=500)) == list(read_and_merge(dbs))
+
+
+@pytest.mark.parametrize("collide", [False, True])
+def test_visit_key_index(collide: bool, monkeypatch: pytest.MonkeyPatch) -> None:
+    from browserexport.dedup import VisitKeyIndex
+
+    if collide:
+        # every key has the same fingerprint, the keys are still compared exactly
+        monkeypatch.setattr("browserexport.dedup.fingerprint", lambda url, ts: 1)
+    keys = [(f"https://example.com/{i % 700}", i % 700) for i in range(2000)]
+    with VisitKeyIndex(max_memory=10_000) as index:
+        added = []
+        for i in range(0, len(keys), 300):
+            added.extend(index.add_many(keys[i : i + 300]))
+            assert index.memory_used() <= 10_000
+        assert added == [True] * 700 + [False] * 1300
+        assert len(index) == 700
+        assert index._spill is not None
+
+
+def test_merge_sorted(chrome: Path, firefox: Path, waterfox: Path) -> None:
+    dbs: Sequence[Path] = [chrome, firefox, waterfox, firefox]
+    merged = list(read_and_merge(dbs, sorted=True))
+    assert merged == sorted(read_and_merge(dbs), key=lambda v: v.dt)
+
+
+def test_merge_sorted_unsorted_source(firefox: Path) -> None:
+    vis = list(read_visits(firefox))
+    with pytest.raises(BrowserexportError, match="isn't sorted"):
+        list(merge_visits([vis, vis[::-1]], sorted=True))
+
+
 def test_read_chrome(chrome: Path) -> None:
     vis = list(read_visits(chrome))
     assert len(vis) == 6
@@ -211,6 +322,510 @@ def test_reading_xz_file(xz_file: Path) -> None:
     assert json_vis[0].url == "https://github.com/junegunn/fzf"
 
 
+@pytest.mark.parametrize(
+    "name",
+    ["chrome", "firefox", "firefox_mobile_legacy", "palemoon", "safari"],
+)
+def test_read_visits_filtered(name: str) -> None:
+    db = _database(name)
+    vis = list(read_visits(db))
+    # between two visits, so float rounding in the extractors doesn't matter
+    mid = vis[len(vis) // 2].dt - timedelta(microseconds=500)
+    assert list(read_visits(db, since=mid)) == [v for v in vis if v.dt >= mid]
+    assert list(read_visits(db, until=mid)) == [v for v in vis if v.dt < mid]
+    assert list(read_visits(db, url_like="%MOZILLA%")) == [
+        v for v in vis if "mozilla" in v.url
+    ]
+
+
+def test_read_visits_filtered_json(jsonl_dump: Path, firefox: Path) -> None:
+    since = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    assert list(read_visits(jsonl_dump, since=since)) == [
+        v for v in read_visits(jsonl_dump) if v.dt >= since
+    ]
+    assert list(
+        read_and_merge([firefox], options=ExtractOptions(url_like="%github%"))
+    ) == [v for v in read_visits(firefox) if "github" in v.url]
+
+
+@pytest.mark.parametrize(
+    "name",
+    ["chrome", "firefox", "palemoon", "safari", "vivaldi"],
+)
+def test_read_visits_fields(name: str) -> None:
+    db = _database(name)
+    vis = list(read_visits(db, fields=("url", "dt")))
+    assert all(v.metadata is None for v in vis)
+    assert [(v.url, v.dt) for v in vis] == [(v.url, v.dt) for v in read_visits(db)]
+
+
+def test_read_visits_fields_json(jsonl_dump: Path) -> None:
+    vis = list(read_visits(jsonl_dump, fields=["url", "dt"]))
+    assert vis == [v._replace(metadata=None) for v in read_visits(jsonl_dump)]
+    with pytest.raises(BrowserexportError, match="must include"):
+        list(read_visits(jsonl_dump, fields=["url"]))
+
+
+@pytest.mark.parametrize(
+    "name",
+    ["chrome", "firefox", "firefox_mobile", "palemoon", "safari", "vivaldi"],
+)
+def test_visit_roundtrip(name: str) -> None:
+    from browserexport.model import Visit
+
+    vis = list(read_visits(_database(name)))
+    # timestamps are rounded the same way when reading JSON, so these dedupe against dumps
+    assert [Visit.from_dict(v.serialize()) for v in vis] == vis
+    assert [v.dt.timestamp() for v in vis] == [v.serialize()["dt"] for v in vis]
+
+
+@pytest.mark.parametrize(
+    "name",
+    ["chrome", "firefox", "firefox_mobile", "palemoon", "safari", "vivaldi"],
+)
+def test_read_visits_batched(name: str) -> None:
+    db = _database(name)
+    vis = list(read_visits(db))
+    batches = list(read_visits_batched(db, batch_size=2))
+    assert [len(b) for b in batches][:-1] == [2] * (len(batches) - 1)
+    assert [v for b in batches for v in b.visits()] == vis
+    assert [int(ts) for b in batches for ts in b.timestamps] == [v.ts for v in vis]
+
+
+def test_read_visits_batched_json(jsonl_dump: Path) -> None:
+    vis = list(read_visits(jsonl_dump, fields=("url", "dt")))
+    batches = list(read_visits_batched(jsonl_dump, fields=("url", "dt")))
+    assert [v for b in batches for v in b.visits()] == vis
+
+
+def test_read_truncated_json(chrome: Path, tmp_path: Path) -> None:
+    import json
+
+    data = json.dumps([v.serialize() for v in read_visits(chrome)])
+    truncated = tmp_path / "truncated.json"
+    truncated.write_text(data[: len(data) // 2])
+    # some visits were already returned, so this doesn't try the browsers
+    with pytest.raises(BrowserexportError, match="after reading [1-9]"):
+        list(read_visits(truncated))
+
+
+def test_read_compressed_sqlite(chrome: Path, tmp_path: Path) -> None:
+    import gzip
+    import lzma
+
+    for mod, ext in ((gzip, "gz"), (lzma, "xz")):
+        target = tmp_path / f"History.sqlite.{ext}"
+        with open(chrome, "rb") as f, mod.open(target, "wb") as out:
+            out.write(f.read())
+        assert list(read_visits(target)) == list(read_visits(chrome))
+
+
+def test_visit_archive(chrome: Path, jsonl_dump: Path, tmp_path: Path) -> None:
+    from browserexport.archive import write_archive, VisitArchive
+
+    vis = list(read_and_merge([chrome, jsonl_dump]))
+    target = tmp_path / "history.visits"
+    assert write_archive(vis, target) == len(vis)
+    assert list(read_visits(target)) == vis
+    with VisitArchive(target) as archive:
+        assert len(archive) == len(vis)
+        assert archive[-1] == vis[-1]
+
+
+def test_sqlite_archive(chrome: Path, firefox: Path, tmp_path: Path) -> None:
+    from browserexport.write import write_visits
+
+    vis = list(read_and_merge([chrome, firefox]))
+    target = tmp_path / "archive.sqlite"
+    assert write_visits(vis, target) == len(vis)
+    assert detect_browser(target, DEFAULT_BROWSERS).__name__ == "BrowserexportArchive"
+    # sorted by visit time when read back
+    assert list(read_visits(target)) == sorted(vis, key=lambda v: v.dt)
+    with pytest.raises(BrowserexportError, match="already exists"):
+        write_visits(vis, target)
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+@pytest.mark.parametrize("lines", [True, False])
+def test_write_json(
+    chrome: Path,
+    firefox: Path,
+    lines: bool,
+    use_orjson: bool,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    import io
+    import json
+    from browserexport.write import write_json
+
+    if not use_orjson:
+        monkeypatch.setitem(sys.modules, "orjson", None)
+    vis = list(read_and_merge([chrome, firefox]))
+    expected = [v.serialize() for v in vis]
+    for batch_size, visits in ((1, vis), (2, vis), (10_000, vis), (2, [])):
+        buf = io.BytesIO()
+        assert write_json(visits, buf, lines=lines, batch_size=batch_size) == len(
+            visits
+        )
+        out = buf.getvalue().decode()
+        if lines:
+            assert [json.loads(ln) for ln in out.splitlines()] == expected[
+                : len(visits)
+            ]
+        else:
+            assert json.loads(out) == expected[: len(visits)]
+
+
+def test_write_jsonl_file(chrome: Path, tmp_path: Path) -> None:
+    from browserexport.write import write_visits
+
+    vis = list(read_visits(chrome))
+    target = tmp_path / "history.jsonl"
+    assert write_visits(vis, target) == len(vis)
+    assert list(read_visits(target)) == vis
+
+
+@pytest.mark.parametrize("flag", ["--json", "--stream"])
+def test_merge_output_json_cli(chrome: Path, tmp_path: Path, flag: str) -> None:
+    from click.testing import CliRunner
+    from browserexport.__main__ import cli
+
+    target = tmp_path / "history.json"
+    result = CliRunner().invoke(cli, ["merge", "-o", str(target), flag, str(chrome)])
+    assert result.exit_code == 2
+    assert "--output can't be used with --json/--stream" in result.output
+    assert not target.exists()
+
+
+def test_merge_max_memory_sorted_cli(chrome: Path) -> None:
+    from click.testing import CliRunner
+    from browserexport.__main__ import cli
+
+    result = CliRunner().invoke(
+        cli, ["merge", "--max-memory", "1M", "--sorted", "--json", str(chrome)]
+    )
+    assert result.exit_code == 2
+    assert "--max-memory can't be used with --sorted" in result.output
+
+
+@pytest.mark.parametrize("fast_decode", [True, False])
+def test_read_options(fast_decode: bool) -> None:
+    from browserexport.sqlite import ReadOptions
+
+    opts = ReadOptions(mmap_size=0, cache_size=0, arraysize=1, fast_decode=fast_decode)
+    for name in ("chrome", "firefox", "safari"):
+        db = _database(name)
+        assert list(read_visits(db, read_options=opts)) == list(read_visits(db))
+        batched = read_visits_batched(db, batch_size=2, read_options=opts)
+        assert [v for b in batched for v in b.visits()] == list(read_visits(db))
+
+
+def test_read_invalid_utf8(tmp_path: Path) -> None:
+    from browserexport.sqlite import ReadOptions, connect, execute_query
+
+    db = tmp_path / "invalid.sqlite"
+    with sqlite3.connect(db) as conn:
+        conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, s TEXT)")
+        conn.execute(
+            "INSERT INTO t (s) VALUES ('a'), ('b'), (CAST(x'63ff64' AS TEXT)), ('e')"
+        )
+    conn.close()
+    expected = ["a", "b", "cd", "e"]
+    query = "SELECT s FROM t ORDER BY id"
+    for fast_decode in (True, False):
+        conn = connect(db, ReadOptions(arraysize=1, fast_decode=fast_decode))
+        try:
+            assert [row["s"] for row in execute_query(conn, query)] == expected
+        finally:
+            conn.close()
+
+
+def test_read_visits_one_connection(monkeypatch: pytest.MonkeyPatch) -> None:
+    import browserexport.parse
+    import browserexport.sqlite
+
+    opened: List[sqlite3.Connection] = []
+    connect = browserexport.sqlite.connect
+
+    def _connect(*args: Any, **kwargs: Any) -> sqlite3.Connection:
+        conn = connect(*args, **kwargs)
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(browserexport.sqlite, "connect", _connect)
+    monkeypatch.setattr(browserexport.parse, "connect", _connect)
+
+    for name in ("chrome", "firefox", "palemoon", "safari"):
+        opened.clear()
+        assert len(list(read_visits(_database(name)))) > 0
+        assert len(opened) == 1
+        # closed once the visits are consumed
+        with pytest.raises(sqlite3.ProgrammingError):
+            opened[0].execute("SELECT 1")
+
+    # or if the generator is closed early
+    opened.clear()
+    it: Any = read_visits(_database("firefox"))
+    next(it)
+    it.close()
+    assert len(opened) == 1
+    with pytest.raises(sqlite3.ProgrammingError):
+        opened[0].execute("SELECT 1")
+
+    # the table names are cached by path, even though the database is read with a connection
+    queried: List[Any] = []
+    query_tables = browserexport.sqlite._query_tables
+
+    def _query_tables(path: Any) -> Any:
+        queried.append(path)
+        return query_tables(path)
+
+    monkeypatch.setattr(browserexport.sqlite, "_query_tables", _query_tables)
+    browserexport.sqlite._tables_cache.clear()
+    for _ in range(3):
+        assert len(list(read_visits(_database("firefox")))) > 0
+    assert len(queried) == 1 and isinstance(queried[0], sqlite3.Connection)
+
+
+def test_merge_snapshots(
+    chrome: Path, firefox: Path, json_dump: Path, tmp_path: Path
+) -> None:
+    import shutil
+    from browserexport.merge import snapshot_options
+
+    def snapshot(name: str, *queries: str) -> Path:
+        p = tmp_path / f"{name}.sqlite"
+        shutil.copy(firefox, p)
+        conn = sqlite3.connect(p)
+        with conn:
+            for q in queries:
+                conn.execute(q)
+        conn.close()
+        return p
+
+    new_visit = "INSERT INTO moz_historyvisits (id, place_id, visit_date) SELECT 5, place_id, visit_date + {} FROM moz_historyvisits WHERE id = 1"
+    older = snapshot("older", "DELETE FROM moz_historyvisits WHERE id = 4")
+    newer = snapshot("newer", new_visit.format(1_000_000))
+    # the newest visit was removed, and its id was reused
+    reused = snapshot(
+        "reused",
+        new_visit.format(1_000_000),
+        "DELETE FROM moz_historyvisits WHERE id = 5",
+        new_visit.format(2_000_000),
+    )
+
+    paths = [newer, chrome, reused, json_dump, older]
+    opts = snapshot_options(paths)
+    assert [o.after_id if o is not None else None for o in opts] == [
+        3,
+        None,
+        None,
+        None,
+        None,
+    ]
+    expected = {(v.url, v.ts) for v in read_and_merge(paths)}
+    assert len(list(read_visits(newer, after_id=3))) == 2
+    for workers in (1, 2):
+        vis = list(read_and_merge(paths, snapshots=True, workers=workers))
+        assert len(vis) == len(expected)
+        assert {(v.url, v.ts) for v in vis} == expected
+
+
+def test_export_new(chrome: Path, tmp_path: Path) -> None:
+    import io
+    import json
+    import shutil
+    from browserexport.incremental import export_new, load_state
+
+    db = tmp_path / "History"
+    shutil.copy(chrome, db)
+    state = tmp_path / "state.json"
+    writer = sqlite3.connect(db)
+    writer.execute("PRAGMA journal_mode=WAL")
+
+    def export() -> List[str]:
+        buf = io.BytesIO()
+        count = export_new("chrome", buf, path=db, state_path=state)
+        lines = buf.getvalue().decode().splitlines()
+        assert count == len(lines)
+        return [json.loads(ln)["url"] for ln in lines]
+
+    def visit(url_id: int, seconds: int) -> None:
+        with writer:
+            writer.execute(
+                "INSERT INTO visits (url, visit_time) SELECT ?, MAX(visit_time) + ? FROM visits",
+                (url_id, seconds * 1_000_000),
+            )
+
+    assert len(export()) == len(list(read_visits(chrome)))
+    assert export() == []
+    mark = load_state(state)[str(db)]
+    assert mark.browser == "chrome"
+
+    # only in the write-ahead log, since the writer is still open
+    visit(37, 10)
+    assert (tmp_path / "History-wal").exists()
+    assert len(export()) == 1
+    assert load_state(state)[str(db)].visit_id == mark.visit_id + 1
+    assert export() == []
+
+    # the newest visit is deleted, and its id is reused by a newer visit
+    with writer:
+        writer.execute("DELETE FROM visits WHERE id = (SELECT MAX(id) FROM visits)")
+    visit(119, 20)
+    assert len(export()) == 1
+    assert export() == []
+    writer.close()
+
+
+def test_save_skip_unchanged(firefox: Path, tmp_path: Path) -> None:
+    import os
+    import shutil
+    from browserexport.save import backup_history
+    from browserexport.browsers.firefox import Firefox
+
+    class LocalFirefox(Firefox):
+        @classmethod
+        def locate_database(cls, profile: str = "*") -> Path:
+            return db
+
+    db = tmp_path / "places.sqlite"
+    shutil.copy(firefox, db)
+    to = tmp_path / "backups"
+    to.mkdir()
+    state = tmp_path / "save.json"
+
+    def save() -> Path:
+        dest = backup_history(LocalFirefox, to, skip_unchanged=True, state_path=state)
+        assert dest is not None and dest.exists()
+        return dest
+
+    first = save()
+    assert first.name.startswith("localfirefox-")
+    assert save() == first
+    # modified, but the contents are the same, so the backups are compared
+    os.utime(db, ns=(0, 0))
+    assert save() == first
+    assert list(to.iterdir()) == [first]
+
+    with sqlite3.connect(db) as conn:
+        conn.execute("DELETE FROM moz_historyvisits WHERE id = 1")
+    conn.close()
+    # may have the same name as the first backup, if it was in the same second
+    second = save()
+    assert len(list(read_visits(second))) == 3
+    assert save() == second
+
+    with pytest.raises(BrowserexportError, match="stdout"):
+        backup_history(LocalFirefox, "-", skip_unchanged=True, state_path=state)
+
+
+@pytest.mark.parametrize("compress", ["gz", "xz", "zst"])
+def test_save_compress(firefox: Path, tmp_path: Path, compress: str) -> None:
+    from browserexport.save import _path_backup
+
+    if compress == "zst":
+        pytest.importorskip("zstandard")
+    dest = _path_backup(firefox, tmp_path, "firefox", compress=compress)
+    assert dest is not None
+    assert dest.name.endswith(f".sqlite.{compress}")
+    assert dest.stat().st_size < firefox.stat().st_size
+    assert list(read_visits(dest)) == list(read_visits(firefox))
+
+
+def test_save_pace(
+    firefox: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    from browserexport.save import _path_backup, Pace
+
+    slept: List[float] = []
+    monkeypatch.setattr("time.sleep", slept.append)
+    pace = Pace(bytes_per_sec=1024**2, step_bytes=16 * 1024, wal_checkpoint=False)
+    dest = _path_backup(firefox, tmp_path, "firefox", pace=pace)
+    assert dest is not None
+    assert list(read_visits(dest)) == list(read_visits(firefox))
+    # copying the file, then the pages in the backup
+    size = firefox.stat().st_size
+    assert len(slept) > size // pace.step()
+    assert sum(slept) <= 2 * size / pace.bytes_per_sec
+
+
+def test_paced_copy_source_changed(
+    firefox: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    import shutil
+    from browserexport.save import _paced_copy, Pace, PACED_COPY_ATTEMPTS
+
+    src, dest = tmp_path / "places.sqlite", tmp_path / "copy.sqlite"
+    shutil.copy(firefox, src)
+    pace = Pace(bytes_per_sec=1024**2, step_bytes=4096, wal_checkpoint=False)
+    changes = [0]
+
+    def change_source(seconds: float) -> None:
+        # rewrite the first block, which has already been copied
+        if changes[0] < limit:
+            changes[0] += 1
+            with open(src, "r+b") as f:
+                f.write(bytes([changes[0] % 256]) * 4096)
+
+    monkeypatch.setattr("time.sleep", change_source)
+    # changed during the first copy, the second one matches
+    limit = 1
+    assert _paced_copy(pace)(str(src), str(dest)) is False
+    assert src.read_bytes() == dest.read_bytes()
+    # changes during every copy, gives up instead of retrying forever
+    changes[0], limit = 0, sys.maxsize
+    assert _paced_copy(pace)(str(src), str(dest)) is False
+    assert changes[0] >= PACED_COPY_ATTEMPTS
+
+
+def test_backup_all(firefox: Path, chrome: Path, tmp_path: Path) -> None:
+    import shutil
+    from browserexport.save import backup_all
+    from browserexport.browsers.common import Paths
+    from browserexport.browsers.chrome import Chrome
+    from browserexport.browsers.firefox import Firefox
+
+    class LocalFirefox(Firefox):
+        @classmethod
+        def data_directories(cls) -> Paths:
+            return (tmp_path / "firefox",)
+
+    class LocalChrome(Chrome):
+        @classmethod
+        def data_directories(cls) -> Paths:
+            return (tmp_path / "chrome",)
+
+    for db, dest in (
+        (firefox, "firefox/abcd.default/places.sqlite"),
+        (firefox, "firefox/efgh.dev-edition/places.sqlite"),
+        (chrome, "chrome/Profile 1/History"),
+    ):
+        (tmp_path / dest).parent.mkdir(parents=True)
+        shutil.copy(db, tmp_path / dest)
+    to = tmp_path / "backups"
+    to.mkdir()
+
+    with pytest.raises(BrowserexportError, match="Expected to match a single"):
+        LocalFirefox.locate_database()
+    assert len(LocalFirefox.locate_databases("abcd*")) == 1
+
+    results = backup_all(to, browsers=[LocalFirefox, LocalChrome], jobs=2)
+    assert [(r.browser, r.profile, r.error) for r in results] == [
+        ("localfirefox", "abcd.default", None),
+        ("localfirefox", "efgh.dev-edition", None),
+        ("localchrome", "Profile_1", None),
+    ]
+    for res in results:
+        assert res.dest is not None and res.dest.parent == to
+        assert res.dest.name.startswith(f"{res.browser}-{res.profile}-")
+        assert res.size == res.dest.stat().st_size
+        assert list(read_visits(res.dest)) == list(read_visits(res.src))
+
+    with pytest.raises(BrowserexportError, match="stdout"):
+        backup_all("-", browsers=[LocalFirefox])
+
+
 def test_mixed_read(json_dump: Path, firefox: Path) -> None:
     jvis = list(read_visits(json_dump))
     fvisits = list(read_visits(firefox))
@@ -1,5 +1,12 @@
-from browserexport.model import test_make_metadata
-from browserexport.parse import _detect_extensions
+from browserexport.model import test_make_metadata  # noqa: F401
+import io
+import sys
+import json
+
+import pytest
+
+from browserexport.parse import _detect_extensions, _read_json_obj
+from browserexport.browsers.common import detector_tables
 
 
 def test_detect_extensions() -> None:
@@ -11,3 +18,135 @@ def test_detect_extensions() -> None:
     assert _detect_extensions("/something/else/foo.jsonl.gz") == ".jsonl"
     assert _detect_extensions("/something/else/foo.jsonl.zstd") == ".jsonl"
     assert _detect_extensions("/something/else/foo.jsonl.xz") == ".jsonl"
+
+
+def test_detector_tables() -> None:
+    assert detector_tables("keyword_search_terms") == {"keyword_search_terms"}
+    assert detector_tables("SELECT * FROM moz_meta, moz_annos") == {
+        "moz_meta",
+        "moz_annos",
+    }
+    assert detector_tables("SELECT * FROM moz_places WHERE id = 1") is None
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_read_json_obj_chunks(
+    use_orjson: bool, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    if not use_orjson:
+        # importing orjson raises an ImportError, so the stdlib decoder is used
+        monkeypatch.setitem(sys.modules, "orjson", None)
+    data = [
+        {"url": "https://example.com/[1],", "dt": 1600133363.72, "metadata": None},
+        {"url": "https://example.com", "dt": 12, "metadata": {"title": "a}, b ]"}},
+        {"url": "https://example.com/{}", "dt": 13, "metadata": None},
+    ]
+    for indent in (None, 2):
+        raw = json.dumps(data, indent=indent)
+        # small chunks, so objects are split across reads
+        for chunk_size in (1, 5, 1000):
+            assert list(_read_json_obj(io.StringIO(raw), chunk_size)) == data
+    assert list(_read_json_obj(io.StringIO("[]"))) == []
+
+
+def test_unquote_by_id() -> None:
+    from browserexport.browsers.common import unquote_by_id
+
+    unquote_url = unquote_by_id()
+    a = unquote_url(1, "https://example.com/a%20b")
+    assert a == "https://example.com/a b"
+    # same id returns the same string object, without unquoting again
+    assert unquote_url(1, "https://example.com/a%20b") is a
+    assert unquote_url(2, "https://example.com/%7E") == "https://example.com/~"
+
+
+def test_visit_namedtuple_compat() -> None:
+    import pickle
+    from datetime import datetime, timezone, timedelta
+
+    from browserexport.model import Visit, Metadata
+
+    dt = datetime(2021, 4, 17, 19, 22, 2, 251821, tzinfo=timezone.utc)
+    md = Metadata.make(title="title")
+    v = Visit(url="https://example.com", dt=dt, metadata=md)
+    assert v.dt == dt and v.ts == 1618687322251821
+    assert v[0] == "https://example.com" and v[1] == dt and v[-1] == md
+    url, vdt, vmd = v
+    assert (url, vdt, vmd) == tuple(v) == ("https://example.com", dt, md)
+    assert v == ("https://example.com", dt, md)
+    assert hash(v) == hash(tuple(v))
+    assert len({v, tuple(v)}) == 1
+    assert v < ("https://example.com", dt.replace(microsecond=0) + timedelta(seconds=1))
+    assert sorted([tuple(v), v._replace(url="https://a")]) == [
+        v._replace(url="https://a"),
+        v,
+    ]
+    assert v._asdict() == {"url": url, "dt": dt, "metadata": md}
+    assert v._replace(metadata=None) == Visit(url, dt)
+    assert v._replace(metadata=None) != v
+    assert Visit._make(v) == v and hash(Visit._make(v)) == hash(v)
+    assert pickle.loads(pickle.dumps(v)) == v
+    assert Visit.from_dict(v.serialize()) == v
+    assert v.serialize()["dt"] == dt.timestamp()
+    assert repr(v).startswith("Visit(url='https://example.com', dt=datetime.datetime(")
+
+
+def test_batch_timestamps() -> None:
+    from browserexport.batch import seconds_to_micros, scaled_seconds_to_micros
+    from browserexport.model import timestamp_to_micros
+
+    chrome = [13263160922251821, 13263160922951821, 13250000000000001]
+    assert list(scaled_seconds_to_micros(chrome, 1_000_000, 11644473600)) == [
+        timestamp_to_micros(t / 1_000_000 - 11644473600) for t in chrome
+    ]
+    secs = [0.0, 1.5, 1593250194.51375, -1.25]
+    assert list(seconds_to_micros(secs, 10)) == [
+        timestamp_to_micros(s + 10) for s in secs
+    ]
+
+
+def test_visit_from_dicts() -> None:
+    import browserexport.model
+    from browserexport.model import Visit
+
+    md = {"title": "t", "description": None, "preview_image": None, "duration": 10}
+    empty = {k: None for k in md}
+    ds = [
+        {"url": "https://a", "dt": 1600133363.72, "metadata": md},
+        {"url": "https://a", "dt": 1600133365.000001, "metadata": dict(md)},
+        {"url": "https://b", "dt": -1.5, "metadata": empty},
+        {"url": "https://b", "dt": 0.0000005, "metadata": None},
+        {"url": "https://c", "dt": 1600133363, "metadata": {"title": "t"}},
+        {"url": "https://c", "dt": 1.25},
+    ]
+    vis = list(Visit.from_dicts(ds))
+    assert vis == list(map(Visit.from_dict, ds))
+    assert vis[0].metadata is vis[1].metadata
+    assert vis[2].metadata is None
+
+    # the shared metadata is cleared once it gets too large
+    size = browserexport.model.SHARED_METADATA_SIZE
+    browserexport.model.SHARED_METADATA_SIZE = 2
+    try:
+        assert list(Visit.from_dicts(ds * 3)) == vis * 3
+    finally:
+        browserexport.model.SHARED_METADATA_SIZE = size
+
+
+def test_read_options_from_env(monkeypatch: pytest.MonkeyPatch) -> None:
+    from browserexport.common import BrowserexportError
+    from browserexport.sqlite import ReadOptions
+
+    assert ReadOptions.from_env() == ReadOptions()
+    monkeypatch.setenv("BROWSEREXPORT_SQLITE_MMAP_SIZE", "0")
+    monkeypatch.setenv("BROWSEREXPORT_SQLITE_TEMP_STORE", "File")
+    monkeypatch.setenv("BROWSEREXPORT_SQLITE_FAST_DECODE", "0")
+    opts = ReadOptions.from_env()
+    assert opts == ReadOptions(mmap_size=0, temp_store="file", fast_decode=False)
+    assert "PRAGMA mmap_size=0" in opts.pragmas()
+
+    monkeypatch.setenv("BROWSEREXPORT_SQLITE_ARRAYSIZE", "many")
+    with pytest.raises(BrowserexportError, match="must be an integer"):
+        ReadOptions.from_env()
+    with pytest.raises(BrowserexportError, match="Unknown temp_store"):
+        ReadOptions(temp_store="disk")